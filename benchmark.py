@@ -0,0 +1,294 @@
+import os
+import glob
+import time
+import timeit
+import import_games
+from board import Board, rook_attacks, bishop_attacks
+from board_batch import BoardBatch
+from tree import OpeningTree, StudyTree
+
+PGN_FILES = sorted(glob.glob(os.path.join("imported_pgns", "**", "*.pgn"), recursive=True))
+
+def load_pgn_games(pgn_files=PGN_FILES):
+    games = []
+    for pgn_file in pgn_files:
+        with open(pgn_file, "r") as f:
+            for pgn in f.read().split("[Event ")[1:]:
+                # Games from a custom starting position (chess960, puzzles) can't be replayed from the start
+                if "[SetUp " not in pgn:
+                    games.append({"pgn": f"[Event {pgn}"})
+    import_games.sanitize_png_moves(games)
+    return games
+
+# (name, fen, node counts for depth 1, 2, ...) from https://www.chessprogramming.org/Perft_Results
+PERFT_POSITIONS = [
+    ("start", Board.STARTING_FEN, [20, 400, 8902, 197281]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", [48, 2039, 97862]),
+    ("position 3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238]),
+    ("position 4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", [6, 264, 9467]),
+    ("position 5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486, 62379]),
+]
+
+def perft(board, depth):
+    moves = board.generate_legal_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        board.push(move, return_fen=False)
+        nodes += perft(board, depth - 1)
+        board.pop()
+    return nodes
+
+def bench_perft(max_depth=3, positions=PERFT_POSITIONS):
+    results = {}
+    for name, fen, node_counts in positions:
+        board = Board(fen)
+        for depth, expected in enumerate(node_counts[:max_depth], start=1):
+            start = time.perf_counter()
+            nodes = perft(board, depth)
+            elapsed = time.perf_counter() - start
+            status = "ok" if nodes == expected else f"FAILED, expected {expected}"
+            print(f"{name:>12} depth {depth}: {nodes:>7} nodes {elapsed:7.3f}s {nodes/elapsed:>9.0f} nodes/s {status}")
+            results[(name, depth)] = (nodes, elapsed)
+            assert nodes == expected, f"perft {name} depth {depth}: {nodes} != {expected}"
+    return results
+
+def bench_board_copy(positions=PERFT_POSITIONS, number=20000):
+    results = {}
+    for name, fen, _ in positions:
+        board = Board(fen)
+        data = board.to_bytes()
+        timings = {
+            "Board(fen)": lambda: Board(fen),
+            "from_bytes": lambda: Board.from_bytes(data),
+            "from_template": lambda: Board.from_template(fen),
+            "copy": board.copy,
+        }
+        for method, func in timings.items():
+            results[(name, method)] = min(timeit.repeat(func, number=number, repeat=3)) / number
+        print(f"{name:>12}: " + "  ".join(f"{method} {results[(name, method)]*1e6:.1f}us" for method in timings))
+    return results
+
+def bench_san_replay(games, repeat=3):
+    plies = sum(len(g.get("clean_moves", [])) for g in games)
+
+    def replay(return_fen):
+        for g in games:
+            b = Board()
+            for move in g.get("clean_moves", []):
+                if b.make_algebraic_move(move, return_fen=return_fen) == -1:
+                    break
+
+    results = {}
+    for name, return_fen in (("replay", False), ("replay + fen", True)):
+        results[name] = min(timeit.repeat(lambda: replay(return_fen), number=1, repeat=repeat))
+        print(f"{name:>14}: {results[name]:.3f}s {plies/results[name]:>9.0f} plies/s")
+    return results
+
+def bench_board_batch(games, repeat=3):
+    positions = []
+    for g in games:
+        packed_positions, _ = Board.replay(g.get("clean_moves", []), fmt="bytes")
+        positions.extend(packed_positions)
+    boards = [Board.from_bytes(data) for data in positions]
+    batch = BoardBatch.from_bytes(positions)
+    assert (batch.in_check() == [bool(b.is_king_in_check(b.whites_move)) for b in boards]).all()
+
+    fens = [b.current_fen for b in boards]
+    assert (BoardBatch.from_fens(fens).bitboards == batch.bitboards).all()
+
+    timings = {
+        "from_bytes": lambda: BoardBatch.from_bytes(positions),
+        "from_fens": lambda: BoardBatch.from_fens(fens),
+        "loop in check": lambda: [b.is_king_in_check(b.whites_move) for b in boards],
+        "batch in check": batch.in_check,
+        "batch material": batch.material,
+    }
+    print(f"{len(positions)} positions")
+    results = {}
+    for name, func in timings.items():
+        results[name] = min(timeit.repeat(func, number=1, repeat=repeat))
+        print(f"{name:>14}: {results[name]:.4f}s")
+    return results
+
+def bench_prepare_games(games, worker_counts=(1, 2, 4), repeat=2):
+    # Speedup of import_games.iter_prepared_games, the import path's sanitize and replay stage, over worker counts.
+    # Every run must give the same games
+    pgns = [{"pgn": g["pgn"]} for g in games]
+    results = {}
+    expected = None
+    for workers in worker_counts:
+        prepared = None
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            prepared = list(import_games.iter_prepared_games((dict(g) for g in pgns), workers=workers))
+            timings.append(time.perf_counter() - start)
+        results[workers] = min(timings)
+        if expected is None:
+            expected = prepared
+        assert prepared == expected, f"iter_prepared_games with {workers} workers differs"
+    print(f"{len(pgns)} games on {os.cpu_count()} cores")
+    for workers, elapsed in results.items():
+        print(f"{workers:>3} workers: {elapsed:.3f}s {len(pgns)/elapsed:>7.0f} games/s {results[worker_counts[0]]/elapsed:.2f}x")
+    return results
+
+def bench_pgn_tokenizer(games, repeat=3):
+    pgns = [g["pgn"] for g in games]
+    tokens = sum(1 for pgn in pgns for _ in import_games.iter_pgn_tokens(pgn))
+    timings = {
+        "tokenize": lambda: [list(import_games.iter_pgn_tokens(pgn)) for pgn in pgns],
+        "sanitize": lambda: [import_games.sanitize_game({"pgn": pgn}) for pgn in pgns],
+    }
+    results = {}
+    for name, func in timings.items():
+        results[name] = min(timeit.repeat(func, number=1, repeat=repeat))
+        print(f"{name:>14}: {results[name]:.3f}s {tokens/results[name]:>10.0f} tokens/s {len(pgns)/results[name]:>8.0f} games/s")
+    return results
+
+def check_pgn_tokenizer(limit=0.1):
+    # Inputs that used to backtrack exponentially in the tokenizer, each must tokenize in linear time
+    pathological = {
+        "trailing blank lines": "1. e4 e5 2. Nf3 1-0" + "\n" * 48,
+        "stray brace": "1. e4 " + " " * 24 + "} e5",
+        "stray bracket": "1. e4 " + " " * 24 + "] e5",
+        "detached suffix": "1. e4 " + " " * 24 + "! e5",
+    }
+    for name, pgn in pathological.items():
+        elapsed = min(timeit.repeat(lambda: list(import_games.iter_pgn_tokens(pgn)), number=1, repeat=3))
+        print(f"{name:>22}: {elapsed*1000:.3f}ms")
+        assert elapsed < limit, f"{name} took {elapsed:.3f}s"
+        assert [value for kind, value in import_games.iter_pgn_tokens(pgn) if kind == import_games.SAN][:2] == ["e4", "e5"]
+    # An unbalanced ) doesn't hide the rest of the main line
+    assert import_games.sanitize_game({"pgn": "1. e4 e5 ) 2. Nf3 Nc6"})["clean_moves"] == ["e4", "e5", "Nf3", "Nc6"]
+
+def bench_opening_tree(games, repeat=3):
+    # Opening trees are built from the stored move codes, the SAN of every edge is decoded from them
+    prepared = [import_games.add_fens(dict(g)) for g in games]
+    plies = sum(len(g.get("move_codes", [])) for g in prepared)
+    timings = {
+        "decode san": lambda: [Board.decode_moves(g.get("move_codes", [])) for g in prepared],
+        "opening tree": lambda: OpeningTree(games=prepared),
+    }
+    results = {}
+    for name, func in timings.items():
+        results[name] = min(timeit.repeat(func, number=1, repeat=repeat))
+        print(f"{name:>14}: {results[name]:.3f}s {plies/results[name]:>9.0f} plies/s")
+    return results
+
+def check_transpositions():
+    # Two move orders reaching the same position, the last move of each order must be a child of its parent
+    orders = ["1. Nf3 Nf6 2. g3 g6 3. Bg2", "1. g3 g6 2. Nf3 Nf6 3. Bh3"]
+    games = [import_games.add_fens(import_games.sanitize_game({"pgn": pgn, "result": "1-0"})) for pgn in orders]
+    opening_tree = OpeningTree(games=games)
+    study_tree = StudyTree({"name": "transpositions", "study_as": "w", "studies": [{"moves": pgn} for pgn in orders]})
+    for tree in (opening_tree, study_tree):
+        for game in games:
+            moves = Board.decode_moves(game["move_codes"])
+            board = Board()
+            for move in moves[:3]:
+                board.push(move)
+            parent = tree.nodes[board.key]
+            board.push(moves[3])
+            assert (tree.nodes[board.key], moves[3]) in parent.children
+        assert sorted(move for _, move in tree.nodes[board.key].children) == ["Bg2", "Bh3"]
+
+def loop_rook_attacks(position, occupancy):
+    attack_bitboard = 0
+    left_attacks = position & 0xFEFEFEFEFEFEFEFE
+    while left_attacks & 0xFEFEFEFEFEFEFEFE != 0:
+        left_attacks >>= 1
+        attack_bitboard |= left_attacks
+        left_attacks &= ~occupancy
+    right_attacks = position & 0x7F7F7F7F7F7F7F7F
+    while right_attacks & 0x7F7F7F7F7F7F7F7F != 0:
+        right_attacks <<= 1
+        attack_bitboard |= right_attacks
+        right_attacks &= ~occupancy
+    up_attacks = position & 0x00FFFFFFFFFFFFFF
+    while up_attacks & 0x00FFFFFFFFFFFFFF != 0:
+        up_attacks <<= 8
+        attack_bitboard |= up_attacks
+        up_attacks &= ~occupancy
+    down_attacks = position & 0xFFFFFFFFFFFFFF00
+    while down_attacks & 0xFFFFFFFFFFFFFF00 != 0:
+        down_attacks >>= 8
+        attack_bitboard |= down_attacks
+        down_attacks &= ~occupancy
+    return attack_bitboard
+
+def loop_bishop_attacks(position, occupancy):
+    attack_bitboard = 0
+    up_left_attacks = position & 0x00FEFEFEFEFEFEFE
+    while up_left_attacks & 0x00FEFEFEFEFEFEFE != 0:
+        up_left_attacks <<= 7
+        attack_bitboard |= up_left_attacks
+        up_left_attacks &= ~occupancy & 0x00FEFEFEFEFEFEFE
+    up_right_attacks = position & 0x007F7F7F7F7F7F7F
+    while up_right_attacks & 0x007F7F7F7F7F7F7F != 0:
+        up_right_attacks <<= 9
+        attack_bitboard |= up_right_attacks
+        up_right_attacks &= ~occupancy & 0x007F7F7F7F7F7F7F
+    down_left_attacks = position & 0xFEFEFEFEFEFEFE00
+    while down_left_attacks & 0xFEFEFEFEFEFEFE00 != 0:
+        down_left_attacks >>= 9
+        attack_bitboard |= down_left_attacks
+        down_left_attacks &= ~occupancy & 0xFEFEFEFEFEFEFE00
+    down_right_attacks = position & 0x7F7F7F7F7F7F7F00
+    while down_right_attacks & 0x7F7F7F7F7F7F7F00 != 0:
+        down_right_attacks >>= 7
+        attack_bitboard |= down_right_attacks
+        down_right_attacks &= ~occupancy & 0x7F7F7F7F7F7F7F00
+    return attack_bitboard
+
+def collect_slider_queries(games):
+    # (square, occupancy) of every rook, bishop and queen in every position reached by the games
+    rook_queries = []
+    bishop_queries = []
+    for g in games:
+        b = Board()
+        for move in g.get("clean_moves", []):
+            if b.make_algebraic_move(move, return_fen=False) == -1:
+                break
+            rooks = b.bb_white_rooks | b.bb_black_rooks | b.bb_white_queens | b.bb_black_queens
+            bishops = b.bb_white_bishops | b.bb_black_bishops | b.bb_white_queens | b.bb_black_queens
+            for square_bitboard in b.separate_bitboards(rooks):
+                rook_queries.append((square_bitboard.bit_length() - 1, b.bb_occupy))
+            for square_bitboard in b.separate_bitboards(bishops):
+                bishop_queries.append((square_bitboard.bit_length() - 1, b.bb_occupy))
+    return rook_queries, bishop_queries
+
+def bench_sliding_attacks(games, repeat=3):
+    rook_queries, bishop_queries = collect_slider_queries(games)
+    for square, occupancy in rook_queries:
+        assert rook_attacks(square, occupancy) == loop_rook_attacks(1 << square, occupancy)
+    for square, occupancy in bishop_queries:
+        assert bishop_attacks(square, occupancy) == loop_bishop_attacks(1 << square, occupancy)
+
+    timings = {
+        "loop rook": lambda: [loop_rook_attacks(1 << s, o) for s, o in rook_queries],
+        "table rook": lambda: [rook_attacks(s, o) for s, o in rook_queries],
+        "loop bishop": lambda: [loop_bishop_attacks(1 << s, o) for s, o in bishop_queries],
+        "table bishop": lambda: [bishop_attacks(s, o) for s, o in bishop_queries],
+    }
+    print(f"{len(rook_queries)} rook/queen and {len(bishop_queries)} bishop/queen lookups")
+    results = {}
+    for name, func in timings.items():
+        results[name] = min(timeit.repeat(func, number=1, repeat=repeat))
+        print(f"{name:>14}: {results[name]:.3f}s")
+    return results
+
+if __name__ == "__main__":
+    bench_perft()
+    bench_board_copy()
+    games = load_pgn_games()
+    print(f"Loaded {len(games)} games from {len(PGN_FILES)} pgn files")
+    bench_san_replay(games)
+    bench_sliding_attacks(games)
+    bench_board_batch(games)
+    check_pgn_tokenizer()
+    check_transpositions()
+    bench_opening_tree(games)
+    bench_pgn_tokenizer(games)
+    bench_prepare_games(games)
@@ -1,14 +1,178 @@
 ﻿import numpy as np
+import random
 import re
+import struct
+from functools import lru_cache
+from polyglot_randoms import POLYGLOT_RANDOM_ARRAY
+
+def build_leaper_table(steps):
+    table = []
+    for square in range(64):
+        rank, file = divmod(square, 8)
+        attack_bitboard = 0
+        for rank_step, file_step in steps:
+            to_rank, to_file = rank + rank_step, file + file_step
+            if 0 <= to_rank < 8 and 0 <= to_file < 8:
+                attack_bitboard |= 1 << (to_rank * 8 + to_file)
+        table.append(attack_bitboard)
+    return table
+
+# Attack masks per square (a1 = 0, h8 = 63), built once at import
+KNIGHT_ATTACKS = build_leaper_table(((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)))
+KING_ATTACKS = build_leaper_table(((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)))
+# PAWN_ATTACKS[white][square], squares attacked by a pawn of that color standing on square
+PAWN_ATTACKS = (build_leaper_table(((-1, -1), (-1, 1))), build_leaper_table(((1, -1), (1, 1))))
+
+# Sliding attacks are looked up per line (rank, file, diagonal, anti-diagonal) by the occupancy
+# of the six inner squares of that line, folded into a 6 bit index with a multiply (kindergarten bitboards)
+FULL_BITBOARD = 0xFFFFFFFFFFFFFFFF
+B_FILE_MULTIPLIER = 0x0202020202020202
+C2_H7_MULTIPLIER = 0x0004081020408000
+
+def ray_attacks(square, occupancy, steps):
+    rank, file = divmod(square, 8)
+    attack_bitboard = 0
+    for rank_step, file_step in steps:
+        to_rank, to_file = rank + rank_step, file + file_step
+        while 0 <= to_rank < 8 and 0 <= to_file < 8:
+            attack_bitboard |= 1 << (to_rank * 8 + to_file)
+            if occupancy >> (to_rank * 8 + to_file) & 1:
+                break
+            to_rank, to_file = to_rank + rank_step, to_file + file_step
+    return attack_bitboard
+
+def build_line_table(steps, edges, file_line=False):
+    table = []
+    for square in range(64):
+        inner_mask = ray_attacks(square, 0, steps) & ~edges
+        shift = square & 7 if file_line else 0
+        multiplier = C2_H7_MULTIPLIER if file_line else B_FILE_MULTIPLIER
+        attacks = [0] * 64
+        occupancy = 0
+        while True:
+            attacks[((occupancy >> shift) * multiplier & FULL_BITBOARD) >> 58] = ray_attacks(square, occupancy, steps)
+            occupancy = (occupancy - inner_mask) & inner_mask
+            if not occupancy:
+                break
+        table.append((inner_mask, attacks))
+    return table
+
+RANK_LINES = build_line_table(((0, 1), (0, -1)), 0x8181818181818181)
+FILE_LINES = build_line_table(((1, 0), (-1, 0)), 0xFF000000000000FF, file_line=True)
+DIAGONAL_LINES = build_line_table(((1, 1), (-1, -1)), 0xFF818181818181FF)
+ANTI_DIAGONAL_LINES = build_line_table(((1, -1), (-1, 1)), 0xFF818181818181FF)
+
+def rook_attacks(square, occupancy):
+    inner_mask, attacks = RANK_LINES[square]
+    attack_bitboard = attacks[((occupancy & inner_mask) * B_FILE_MULTIPLIER & FULL_BITBOARD) >> 58]
+    inner_mask, attacks = FILE_LINES[square]
+    return attack_bitboard | attacks[(((occupancy & inner_mask) >> (square & 7)) * C2_H7_MULTIPLIER & FULL_BITBOARD) >> 58]
+
+def bishop_attacks(square, occupancy):
+    inner_mask, attacks = DIAGONAL_LINES[square]
+    attack_bitboard = attacks[((occupancy & inner_mask) * B_FILE_MULTIPLIER & FULL_BITBOARD) >> 58]
+    inner_mask, attacks = ANTI_DIAGONAL_LINES[square]
+    return attack_bitboard | attacks[((occupancy & inner_mask) * B_FILE_MULTIPLIER & FULL_BITBOARD) >> 58]
+
+def build_between_tables():
+    # BETWEEN[a][b]: squares strictly between two aligned squares, LINE[a][b]: the full line through both
+    between = [[0] * 64 for _ in range(64)]
+    line = [[0] * 64 for _ in range(64)]
+    for from_square in range(64):
+        for slider_attacks in (rook_attacks, bishop_attacks):
+            empty_attacks = slider_attacks(from_square, 0)
+            for to_square in range(64):
+                if empty_attacks >> to_square & 1:
+                    between[from_square][to_square] = slider_attacks(from_square, 1 << to_square) & slider_attacks(to_square, 1 << from_square)
+                    line[from_square][to_square] = (empty_attacks & slider_attacks(to_square, 0)) | (1 << from_square) | (1 << to_square)
+    return between, line
+
+BETWEEN, LINE = build_between_tables()
+
+def build_zobrist_tables(seed):
+    # Fixed seed so a position gets the same key in every run and keys can be stored
+    rng = random.Random(seed)
+    # Indexed [piece][square] with the piece number, black pieces through negative indexing like NUMBER_TO_PIECE
+    pieces = [[0] * 64] + [[rng.getrandbits(64) for _ in range(64)] for _ in range(12)]
+    castling = [0] + [rng.getrandbits(64) for _ in range(15)]
+    en_passant = [rng.getrandbits(64) for _ in range(8)]
+    return pieces, castling, en_passant, rng.getrandbits(64)
+
+ZOBRIST_PIECES, ZOBRIST_CASTLING, ZOBRIST_EN_PASSANT, ZOBRIST_BLACK_TO_MOVE = build_zobrist_tables(361)
+
+# Polyglot piece kind of every piece number: black pawn 0, white pawn 1, black knight 2, ... white king 11
+POLYGLOT_PIECE_KINDS = [0] + [2 * piece - 1 for piece in range(1, 7)] + [2 * piece - 2 for piece in range(6, 0, -1)]
+POLYGLOT_CASTLING, POLYGLOT_EN_PASSANT, POLYGLOT_TURN = 768, 772, 780
+
+# Packed position: 64 piece nibbles (two squares a byte, low nibble first), side to move and castling rights,
+# en passant square (255 for none), halfmove clock and move number. 38 bytes
+POSITION_STRUCT = struct.Struct("<32sBBHH")
+NO_EN_PASSANT = 255
+# Piece numbers of the low and high nibble of every byte, black pieces are stored as piece & 0xF
+NIBBLE_PIECES = [tuple(nibble - 16 if nibble > 8 else nibble for nibble in (byte & 0xF, byte >> 4)) for byte in range(256)]
+
+# Bitboard attribute of every piece number, pop() puts the pieces of an undo record back through them
+PIECE_BITBOARD_NAMES = {1: "bb_white_pawns", 2: "bb_white_knights", 3: "bb_white_bishops", 4: "bb_white_rooks", 5: "bb_white_queens", 6: "bb_white_king",
+                        -1: "bb_black_pawns", -2: "bb_black_knights", -3: "bb_black_bishops", -4: "bb_black_rooks", -5: "bb_black_queens", -6: "bb_black_king"}
+# Rook (from, to) squares of a castling move by the king's to square
+CASTLING_ROOK_SQUARES = {6: (7, 5), 2: (0, 3), 62: (63, 61), 58: (56, 59)}
+
+# 16 bit move code: from square | to square << 6 | promotion piece << 12 | flag << 14
+MOVE_NORMAL, MOVE_PROMOTION, MOVE_EN_PASSANT, MOVE_CASTLE = range(4)
+PROMOTION_PIECES = "NBRQ"
+# previous_fen of a board whose last move was pushed without building its FEN, see Board.last_fen
+PUSHED_POSITION = object()
+# Algebraic name of every square index, a1 = 0
+SQUARE_NAMES = [f"{chr(ord('a') + square % 8)}{square // 8 + 1}" for square in range(64)]
+
+def move_code_to_uci(code):
+    from_square, to_square, flag = code & 0x3F, code >> 6 & 0x3F, code >> 14
+    uci = f"{chr(ord('a') + from_square % 8)}{from_square // 8 + 1}{chr(ord('a') + to_square % 8)}{to_square // 8 + 1}"
+    if flag == MOVE_PROMOTION:
+        uci += PROMOTION_PIECES[code >> 12 & 0x3].lower()
+    return uci
+
+SAN_REGEX = re.compile(r"([NBRQK])?([a-h])?([1-8])?(x)?([a-h][1-8])(?:=?([NBRQ]))?")
+CASTLE_REGEX = re.compile(r"([Oo0])-\1(-\1)?")
+
+@lru_cache(maxsize=4096)
+def parse_san(move):
+    # (piece, to bitboard, from mask, capture, promotion) of a SAN token, None if it isn't one.
+    # piece is 'P' for pawns and 'O-O' / 'O-O-O' for castling, check and annotation suffixes are ignored
+    castle = CASTLE_REGEX.match(move)
+    if castle:
+        return ('O-O-O' if castle.group(2) else 'O-O', 0, FULL_BITBOARD, False, None)
+    san = SAN_REGEX.match(move)
+    if not san:
+        return None
+    piece, from_file, from_rank, capture, to_square, promote = san.groups()
+    if not piece:
+        piece = 'P'
+    from_mask = FULL_BITBOARD
+    if from_file:
+        from_mask &= Board.FILE_BITBOARDS[ord(from_file) - ord('a')]
+    if from_rank:
+        from_mask &= Board.RANK_BITBOARDS[int(from_rank) - 1]
+    to_square_bitboard = 1 << (ord(to_square[0]) - ord('a') + (int(to_square[1]) - 1) * 8)
+    return (piece, to_square_bitboard, from_mask, bool(capture), promote)
 
 class Board():
 
+    __slots__ = ("squares", "rank_fens",
+                 "bb_white_pawns", "bb_white_knights", "bb_white_bishops", "bb_white_rooks", "bb_white_queens", "bb_white_king",
+                 "bb_black_pawns", "bb_black_knights", "bb_black_bishops", "bb_black_rooks", "bb_black_queens", "bb_black_king",
+                 "bb_white_occupy", "bb_black_occupy", "bb_occupy",
+                 "whites_move", "castling_rights", "en_passant_square", "halfmove_clock", "move_number", "key",
+                 "undo_stack", "cached_fen", "previous_fen", "init_fen", "result")
+
     PIECE_TO_NUMBER = {'K':6, 'k':-6, 'Q':5,'q':-5, 'R':4,'r':-4,'B':3,'b':-3, 'N':2,'n':-2,'P':1,'p':-1,'.':0}
     NUMBER_TO_PIECE = ['.', 'P', 'N', 'B', 'R', 'Q', 'K', 'k', 'q', 'r', 'b', 'n', 'p'] #{v:k for k,v in PIECE_TO_NUMBER.items()}
     NUMBER_TO_PIECE_EMOJI = {6: '♚', -6: '♔', 5: '♛', -5: '♕', 4: '♜', -4: '♖', 3: '♝', -3: '♗', 2: '♞', -2: '♘', 1: '♟', -1: '♙', 0: '.'}
     pks = PIECE_TO_NUMBER.keys()
     
     STARTING_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+    # The starting position, copied by from_template() instead of parsing its FEN again
+    starting_template = None
    
     WHITE_KING_CASTLE = 0b1
     WHITE_QUEEN_CASTLE = 0b10
@@ -34,8 +198,6 @@ class Board():
                    ]
 
     def __init__(self, fen = None):
-        self.board  = np.zeros((8,8), dtype = np.int8)
-        self.reverse_view_board = self.board[::-1]
         self.result= -1
         if not fen:
             fen = Board.STARTING_FEN
@@ -45,19 +207,22 @@ class Board():
         self.set_up_chessboard(fen)
 
     def set_up_chessboard(self, fen_string):
-        rank, file = 0, 0
+        # Mailbox of piece numbers indexed by square (a1 = 0, h8 = 63), the bitboards are filled in the same pass
+        self.squares = [0] * 64
+        self.rank_fens = [None] * 8
+        bitboards = [0] * 13
+        square = 56
         fen_string = fen_string.split(" ")
         for char in fen_string[0]:
-            if char == ' ':
-                break
             if char == '/':
-                rank += 1
-                file = 0
+                square -= 16
             elif char.isdigit():
-                file += int(char)
+                square += int(char)
             else:
-                self.board[7 - rank][file] = Board.PIECE_TO_NUMBER.get(char)
-                file += 1
+                piece = Board.PIECE_TO_NUMBER[char]
+                self.squares[square] = piece
+                bitboards[piece] |= 1 << square
+                square += 1
         if fen_string[1]:
             if fen_string[1][0] == 'b' or fen_string[1][0] == 'B':
                 self.whites_move = 0
@@ -83,8 +248,129 @@ class Board():
             self.halfmove_clock = int(fen_string[4])
         if fen_string[5]:
             self.move_number= int(fen_string[5])
-        self.init_bitboards()
-        return self.board
+        self.undo_stack = []
+        self.set_bitboards(bitboards)
+        self.key = self.compute_key()
+        return self.squares
+
+    @property
+    def current_fen(self):
+        # Built on first read after a move, only the ranks the move touched are serialised again
+        if self.cached_fen is None:
+            self.cached_fen = self.export_fen()
+        return self.cached_fen
+
+    @current_fen.setter
+    def current_fen(self, fen):
+        self.cached_fen = fen
+
+    @property
+    def last_fen(self):
+        # FEN before the last move. A move made without building FENs leaves what it is built from here: the undo
+        # record of a push, or a snapshot of the mailbox and state fields from make_algebraic_move
+        previous = self.previous_fen
+        if previous is PUSHED_POSITION:
+            cached_fen = self.cached_fen
+            move = self.pop()
+            previous = self.current_fen
+            self.push(move, return_fen=False)
+            self.cached_fen = cached_fen
+        elif isinstance(previous, tuple):
+            board = Board.__new__(Board)
+            board.squares, board.whites_move, board.castling_rights, board.en_passant_square, board.halfmove_clock, board.move_number = previous
+            board.rank_fens = [None] * 8
+            previous = board.export_fen()
+        self.previous_fen = previous
+        return previous
+
+    @last_fen.setter
+    def last_fen(self, fen):
+        self.previous_fen = fen
+
+    @property
+    def board(self):
+        # numpy copy of the mailbox as board[rank][file], for display code
+        return np.array(self.squares, dtype=np.int8).reshape(8, 8)
+
+    @classmethod
+    def from_bytes(cls, data):
+        board = cls.__new__(cls)
+        board.result = -1
+        board.last_fen = None
+        board.init_fen = None
+        board.current_fen = None
+        board.set_up_from_bytes(data)
+        return board
+
+    def set_up_from_bytes(self, data):
+        packed_squares, flags, en_passant, self.halfmove_clock, self.move_number = POSITION_STRUCT.unpack(data)
+        self.squares = [0] * 64
+        self.rank_fens = [None] * 8
+        bitboards = [0] * 13
+        for index, byte in enumerate(packed_squares):
+            if byte:
+                square = index * 2
+                for piece in NIBBLE_PIECES[byte]:
+                    if piece:
+                        self.squares[square] = piece
+                        bitboards[piece] |= 1 << square
+                    square += 1
+        self.whites_move = flags & 1
+        self.castling_rights = flags >> 1
+        self.en_passant_square = None if en_passant == NO_EN_PASSANT else (en_passant % 8, en_passant // 8)
+        self.undo_stack = []
+        self.set_bitboards(bitboards)
+        self.key = self.compute_key()
+        return self.squares
+
+    def to_bytes(self):
+        squares = self.squares
+        packed_squares = bytes((squares[square] & 0xF) | (squares[square + 1] & 0xF) << 4 for square in range(0, 64, 2))
+        en_passant = NO_EN_PASSANT if not self.en_passant_square else self.en_passant_square[0] + self.en_passant_square[1] * 8
+        flags = (1 if self.whites_move else 0) | self.castling_rights << 1
+        return POSITION_STRUCT.pack(packed_squares, flags, en_passant, self.halfmove_clock, self.move_number)
+
+    def compute_key(self):
+        key = 0
+        for square, piece in enumerate(self.squares):
+            if piece:
+                key ^= ZOBRIST_PIECES[piece][square]
+        key ^= ZOBRIST_CASTLING[self.castling_rights]
+        if self.en_passant_square:
+            key ^= ZOBRIST_EN_PASSANT[self.en_passant_square[0]]
+        if not self.whites_move:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        return key
+
+    def polyglot_key(self):
+        # Key of the position in Polyglot opening books, en passant only counts when a pawn can take
+        key = 0
+        for square, piece in enumerate(self.squares):
+            if piece:
+                key ^= POLYGLOT_RANDOM_ARRAY[64 * POLYGLOT_PIECE_KINDS[piece] + square]
+        for right in range(4):
+            if self.castling_rights & 1 << right:
+                key ^= POLYGLOT_RANDOM_ARRAY[POLYGLOT_CASTLING + right]
+        if self.en_passant_square:
+            file, rank = self.en_passant_square
+            pawns = self.bb_white_pawns if self.whites_move else self.bb_black_pawns
+            if PAWN_ATTACKS[not self.whites_move][file + rank * 8] & pawns:
+                key ^= POLYGLOT_RANDOM_ARRAY[POLYGLOT_EN_PASSANT + file]
+        if self.whites_move:
+            key ^= POLYGLOT_RANDOM_ARRAY[POLYGLOT_TURN]
+        return key
+
+    def remove_castling_rights(self, rights):
+        self.key ^= ZOBRIST_CASTLING[self.castling_rights]
+        self.castling_rights &= ~rights
+        self.key ^= ZOBRIST_CASTLING[self.castling_rights]
+
+    def set_en_passant_square(self, square):
+        if self.en_passant_square:
+            self.key ^= ZOBRIST_EN_PASSANT[self.en_passant_square[0]]
+        if square:
+            self.key ^= ZOBRIST_EN_PASSANT[square[0]]
+        self.en_passant_square = square
     def rank_to_fen(self,rank):
         empty = 0
         fen = ''
@@ -100,7 +386,11 @@ class Board():
 
     def export_fen(self):
 
-        board_fen = '/'.join(self.rank_to_fen(rank) for rank in self.reverse_view_board)
+        rank_fens = self.rank_fens
+        for rank in range(8):
+            if rank_fens[rank] is None:
+                rank_fens[rank] = self.rank_to_fen(self.squares[rank*8:rank*8+8])
+        board_fen = '/'.join(rank_fens[::-1])
         turn_fen = 'w' if self.whites_move else 'b'
         castling_fen = ''.join([
             'K' if self.castling_rights & Board.WHITE_KING_CASTLE else '',
@@ -120,18 +410,15 @@ class Board():
         ])
 
     def init_bitboards(self):
-        self.bb_white_pawns = int(((self.board == 1).flatten() << np.arange(64,dtype=np.uint64)).sum())
-        self.bb_black_pawns = int(((self.board == -1).flatten() << np.arange(64,dtype=np.uint64)).sum())
-        self.bb_white_knights = int(((self.board == 2).flatten() << np.arange(64,dtype=np.uint64)).sum())
-        self.bb_black_knights = int(((self.board == -2).flatten() << np.arange(64, dtype=np.uint64)).sum())
-        self.bb_white_bishops = int(((self.board == 3).flatten() << np.arange(64, dtype=np.uint64)).sum())
-        self.bb_black_bishops = int(((self.board == -3).flatten() << np.arange(64,dtype=np.uint64)).sum())
-        self.bb_white_rooks = int(((self.board == 4).flatten() << np.arange(64,dtype=np.uint64)).sum())
-        self.bb_black_rooks = int(((self.board == -4).flatten() << np.arange(64,dtype=np.uint64)).sum())
-        self.bb_white_queens = int(((self.board == 5).flatten() << np.arange(64,dtype=np.uint64)).sum())
-        self.bb_black_queens = int(((self.board == -5).flatten() << np.arange(64,dtype=np.uint64)).sum())
-        self.bb_white_king = int(((self.board == 6).flatten() << np.arange(64,dtype=np.uint64)).sum())
-        self.bb_black_king = int(((self.board == -6).flatten() << np.arange(64,dtype=np.uint64)).sum())
+        bitboards = [0] * 13
+        for square, piece in enumerate(self.squares):
+            bitboards[piece] |= 1 << square
+        self.set_bitboards(bitboards)
+
+    def set_bitboards(self, bitboards):
+        # bitboards indexed by piece number, black pieces through negative indexing
+        (_, self.bb_white_pawns, self.bb_white_knights, self.bb_white_bishops, self.bb_white_rooks, self.bb_white_queens, self.bb_white_king,
+         self.bb_black_king, self.bb_black_queens, self.bb_black_rooks, self.bb_black_bishops, self.bb_black_knights, self.bb_black_pawns) = bitboards
         self.bb_white_occupy = self.bb_white_pawns | self.bb_white_knights | self.bb_white_bishops | self.bb_white_rooks | self.bb_white_queens | self.bb_white_king
         self.bb_black_occupy = self.bb_black_pawns | self.bb_black_knights | self.bb_black_bishops | self.bb_black_rooks | self.bb_black_queens | self.bb_black_king
         self.bb_occupy = self.bb_white_occupy | self.bb_black_occupy
@@ -203,14 +490,20 @@ class Board():
         
         from_coord = self.bitboard_to_coordinate(from_bb)
         to_coord = self.bitboard_to_coordinate(to_bb)
+        from_square = from_bb.bit_length() - 1
+        to_square = to_bb.bit_length() - 1
+        piece = self.squares[from_square]
+        captured = self.squares[to_square]
+        self.rank_fens[from_square >> 3] = self.rank_fens[to_square >> 3] = self.cached_fen = None
         if self.coordinate_to_bitboard(self.en_passant_square) == to_bb:
-            self.board[to_coord[1]][to_coord[0]] = self.board[from_coord[1]][from_coord[0]]
+            self.squares[to_square] = piece
+            self.key ^= ZOBRIST_PIECES[piece][from_square] ^ ZOBRIST_PIECES[piece][to_square] ^ ZOBRIST_PIECES[-piece][to_square - 8 if self.whites_move else to_square + 8]
             self.bb_occupy ^= (from_bb | to_bb)
             if self.whites_move: 
                 self.bb_white_pawns ^= (from_bb | to_bb)
                 self.bb_white_occupy ^= (from_bb | to_bb)
 
-                self.board[to_coord[1]-1][to_coord[0]] = 0
+                self.squares[to_square - 8] = 0
                 self.bb_black_pawns ^= to_bb >> 8
                 self.bb_black_occupy ^= to_bb >> 8
                 self.bb_occupy ^= to_bb >> 8
@@ -218,13 +511,14 @@ class Board():
                 self.bb_black_pawns ^= (from_bb | to_bb)
                 self.bb_black_occupy ^= (from_bb | to_bb)
 
-                self.board[to_coord[1]+1][to_coord[0]] = 0
+                self.squares[to_square + 8] = 0
                 self.bb_white_pawns ^= to_bb << 8
                 self.bb_white_occupy ^= to_bb << 8
                 self.bb_occupy ^= to_bb << 8
                 
         elif not promote:
-            self.board[to_coord[1]][to_coord[0]] = self.board[from_coord[1]][from_coord[0]]
+            self.squares[to_square] = piece
+            self.key ^= ZOBRIST_PIECES[piece][from_square] ^ ZOBRIST_PIECES[piece][to_square] ^ ZOBRIST_PIECES[captured][to_square]
             to_bb_mask = ~to_bb
 
             if self.whites_move: 
@@ -253,13 +547,14 @@ class Board():
         else:
             to_bb_mask = ~to_bb
             promote = promote.lower() if not self.whites_move else promote
-            self.board[to_coord[1]][to_coord[0]] = Board.PIECE_TO_NUMBER[promote]
+            self.squares[to_square] = Board.PIECE_TO_NUMBER[promote]
+            self.key ^= ZOBRIST_PIECES[piece][from_square] ^ ZOBRIST_PIECES[Board.PIECE_TO_NUMBER[promote]][to_square] ^ ZOBRIST_PIECES[captured][to_square]
 
             if self.whites_move:
                 if to_coord == (0,7):
-                    self.castling_rights &= ~self.BLACK_QUEEN_CASTLE
+                    self.remove_castling_rights(self.BLACK_QUEEN_CASTLE)
                 if to_coord == (7,7):
-                    self.castling_rights &= ~self.BLACK_KING_CASTLE
+                    self.remove_castling_rights(self.BLACK_KING_CASTLE)
                 match Board.PIECE_TO_NUMBER[promote]:
                     case 2:   
                         self.bb_white_knights ^= to_bb
@@ -280,9 +575,9 @@ class Board():
                 self.bb_black_occupy &= to_bb_mask
             else:
                 if to_coord == (0,0):
-                    self.castling_rights &= ~self.WHITE_QUEEN_CASTLE
+                    self.remove_castling_rights(self.WHITE_QUEEN_CASTLE)
                 if to_coord == (7,0):
-                    self.castling_rights &= ~self.WHITE_KING_CASTLE
+                    self.remove_castling_rights(self.WHITE_KING_CASTLE)
                 match Board.PIECE_TO_NUMBER[promote]:
                     case -2:
                         self.bb_black_knights ^= to_bb
@@ -303,17 +598,18 @@ class Board():
                 self.bb_white_occupy &= to_bb_mask
             self.bb_occupy = self.bb_white_occupy | self.bb_black_occupy
 
-        self.board[from_coord[1]][from_coord[0]] = 0
+        self.squares[from_square] = 0
         
         double_move = from_bb << 16 == to_bb or from_bb >> 16 == to_bb
         if double_move:
-            self.en_passant_square = (from_coord[0], (from_coord[1]+to_coord[1])//2)
+            self.set_en_passant_square((from_coord[0], (from_coord[1]+to_coord[1])//2))
         else:
-            self.en_passant_square = None
+            self.set_en_passant_square(None)
         if not self.whites_move:
             self.move_number+=1
         self.halfmove_clock = 0
         self.whites_move = not self.whites_move 
+        self.key ^= ZOBRIST_BLACK_TO_MOVE
 
     def separate_bitboards(self, bitboard):
         set_bits = []
@@ -327,51 +623,42 @@ class Board():
     def amb_from(self, from_bbs, to_bb):
         if (from_bbs & (from_bbs - 1)) == 0:
             return from_bbs
-        org_board = self.board.copy()
-        to_coord = self.bitboard_to_coordinate(to_bb)
-        correct_from_bb = []
-        for from_bb in self.separate_bitboards(from_bbs):
-            self.board = org_board.copy()
-            from_coord = self.bitboard_to_coordinate(from_bb)
-            self.board[to_coord[1]][to_coord[0]] = self.board[from_coord[1]][from_coord[0]]
-            self.board[from_coord[1]][from_coord[0]] = 0
-            self.init_bitboards()
-            if not self.is_king_in_check(self.whites_move):
-                correct_from_bb.append(from_bb)
-        if len(correct_from_bb) != 1:
-            print("AHHHHHHHHH")
-        self.board = org_board
-        self.reverse_view_board = self.board[::-1]
-        self.init_bitboards()
-        return correct_from_bb[0]
-    
-
+        legal_moves = self.generate_legal_moves(from_bbs, to_bb)
+        if not legal_moves:
+            return 0
+        return legal_moves[0][0]
 
     def move_piece(self, from_bb, to_bb):
 
         from_coord = self.bitboard_to_coordinate(from_bb)
         to_coord = self.bitboard_to_coordinate(to_bb)
-        if self.board[to_coord[1]][to_coord[0]]:
+        from_square = from_bb.bit_length() - 1
+        to_square = to_bb.bit_length() - 1
+        captured = self.squares[to_square]
+        self.rank_fens[from_square >> 3] = self.rank_fens[to_square >> 3] = self.cached_fen = None
+        if captured:
             if self.whites_move:
                 if to_coord == (0,7):
-                    self.castling_rights &= ~self.BLACK_QUEEN_CASTLE
+                    self.remove_castling_rights(self.BLACK_QUEEN_CASTLE)
                 if to_coord == (7,7):
-                    self.castling_rights &= ~self.BLACK_KING_CASTLE
+                    self.remove_castling_rights(self.BLACK_KING_CASTLE)
             else:
                 if to_coord == (0,0):
-                    self.castling_rights &= ~self.WHITE_QUEEN_CASTLE
+                    self.remove_castling_rights(self.WHITE_QUEEN_CASTLE)
                 if to_coord == (7,0):
-                    self.castling_rights &= ~self.WHITE_KING_CASTLE
+                    self.remove_castling_rights(self.WHITE_KING_CASTLE)
             self.halfmove_clock = 0
-        self.board[to_coord[1]][to_coord[0]] = self.board[from_coord[1]][from_coord[0]]
-        piece = self.board[from_coord[1]][from_coord[0]]
-        self.board[from_coord[1]][from_coord[0]] = 0
+        piece = self.squares[from_square]
+        self.key ^= ZOBRIST_PIECES[piece][from_square] ^ ZOBRIST_PIECES[piece][to_square] ^ ZOBRIST_PIECES[captured][to_square]
+        self.squares[to_square] = piece
+        self.squares[from_square] = 0
         
         if not self.whites_move:
             self.move_number+=1
         self.update_bitboards(from_bb, to_bb, piece)
         self.whites_move = not self.whites_move
-        self.en_passant_square = None
+        self.key ^= ZOBRIST_BLACK_TO_MOVE
+        self.set_en_passant_square(None)
         
 
     def move_rook(self, from_bb, to_bb):
@@ -379,69 +666,64 @@ class Board():
             from_bb = self.amb_from(from_bb, to_bb)
         if self.whites_move:
             if from_bb == 0x0000000000000080:
-                self.castling_rights &= ~self.WHITE_KING_CASTLE
+                self.remove_castling_rights(self.WHITE_KING_CASTLE)
             elif from_bb == 0x0000000000000001:
-                self.castling_rights &= ~self.WHITE_QUEEN_CASTLE
+                self.remove_castling_rights(self.WHITE_QUEEN_CASTLE)
         else:
             if from_bb == 0x8000000000000000:
-                self.castling_rights &= ~self.BLACK_KING_CASTLE
+                self.remove_castling_rights(self.BLACK_KING_CASTLE)
             elif from_bb == 0x0100000000000000:
-                self.castling_rights &= ~self.BLACK_QUEEN_CASTLE
+                self.remove_castling_rights(self.BLACK_QUEEN_CASTLE)
         return self.move_piece(from_bb,to_bb)
     def move_king(self, from_bb, to_bb):
         if self.whites_move:
-            self.castling_rights &= ~self.WHITE_KING_CASTLE
-            self.castling_rights &= ~self.WHITE_QUEEN_CASTLE
+            self.remove_castling_rights(self.WHITE_KING_CASTLE | self.WHITE_QUEEN_CASTLE)
         else:
-            self.castling_rights &= ~self.BLACK_KING_CASTLE        
-            self.castling_rights &= ~self.BLACK_QUEEN_CASTLE
+            self.remove_castling_rights(self.BLACK_KING_CASTLE | self.BLACK_QUEEN_CASTLE)
         return self.move_piece(from_bb,to_bb)
 
     def move_castle(self, from_bb, to_bb):
         if self.whites_move:
-            self.castling_rights &= ~self.WHITE_KING_CASTLE
-            self.castling_rights &= ~self.WHITE_QUEEN_CASTLE
+            self.remove_castling_rights(self.WHITE_KING_CASTLE | self.WHITE_QUEEN_CASTLE)
             if to_bb == 0x0000000000000040: # King-side castling
                 self.bb_white_rooks ^= 0x00000000000000a0
                 self.bb_white_occupy ^= 0x00000000000000a0
                 self.bb_occupy ^= 0x00000000000000a0
-                self.board[0][5],self.board[0][7] = self.board[0][7],0             
+                self.squares[5],self.squares[7] = self.squares[7],0
+                self.key ^= ZOBRIST_PIECES[4][7] ^ ZOBRIST_PIECES[4][5]
             else:
                 self.bb_white_rooks ^= 0x0000000000000009
                 self.bb_white_occupy ^= 0x0000000000000009
                 self.bb_occupy ^= 0x0000000000000009
-                self.board[0][3],self.board[0][0] = self.board[0][0],0
+                self.squares[3],self.squares[0] = self.squares[0],0
+                self.key ^= ZOBRIST_PIECES[4][0] ^ ZOBRIST_PIECES[4][3]
             self.move_piece(from_bb, to_bb)
         else:
-            self.castling_rights &= ~self.BLACK_KING_CASTLE        
-            self.castling_rights &= ~self.BLACK_QUEEN_CASTLE
+            self.remove_castling_rights(self.BLACK_KING_CASTLE | self.BLACK_QUEEN_CASTLE)
             if to_bb == 0x4000000000000000: # King-side castling
                 self.bb_black_rooks ^= 0xa000000000000000
                 self.bb_black_occupy ^= 0xa000000000000000
                 self.bb_occupy ^= 0xa000000000000000
-                self.board[7][5],self.board[7][7] = self.board[7][7],0
+                self.squares[61],self.squares[63] = self.squares[63],0
+                self.key ^= ZOBRIST_PIECES[-4][63] ^ ZOBRIST_PIECES[-4][61]
             else:
                 self.bb_black_rooks ^= 0x0900000000000000
                 self.bb_black_occupy ^= 0x0900000000000000
                 self.bb_occupy ^= 0x0900000000000000
-                self.board[7][3],self.board[7][0] = self.board[7][0],0
+                self.squares[59],self.squares[56] = self.squares[56],0
+                self.key ^= ZOBRIST_PIECES[-4][56] ^ ZOBRIST_PIECES[-4][59]
             self.move_piece(from_bb, to_bb)
 
-    def make_pawn_move(self, move):
-        if '=' in move:
-            promote_peice = move.split('=')[1][0]
-        else:
-            promote_peice=None
-        
-        from_square_bitboard, to_square_bitboard = self.get_to_from_pawn_move(move)
+    def make_pawn_move(self, parsed_move):
+        from_square_bitboard, to_square_bitboard = self.get_to_from_parsed_move(parsed_move)
         if from_square_bitboard and to_square_bitboard:
-            self.move_pawn(from_square_bitboard, to_square_bitboard, promote_peice)
+            self.move_pawn(from_square_bitboard, to_square_bitboard, parsed_move[4])
             return 1
         else:
             print("not valid")
             return -1
-    def make_knight_move(self, move):
-        from_square_bitboard, to_square_bitboard = self.get_to_from_knight_move(move)
+    def make_knight_move(self, parsed_move):
+        from_square_bitboard, to_square_bitboard = self.get_to_from_parsed_move(parsed_move)
         if from_square_bitboard and to_square_bitboard:
             self.move_piece(from_square_bitboard, to_square_bitboard)
             return 1
@@ -449,8 +731,8 @@ class Board():
             print("not valid")
             return -1
 
-    def make_bishop_move(self, move):
-        from_square_bitboard, to_square_bitboard = self.get_to_from_bishop_move(move)
+    def make_bishop_move(self, parsed_move):
+        from_square_bitboard, to_square_bitboard = self.get_to_from_parsed_move(parsed_move)
         if from_square_bitboard and to_square_bitboard:
             self.move_piece(from_square_bitboard, to_square_bitboard)
             return 1
@@ -458,8 +740,8 @@ class Board():
             print("not valid")
             return -1
 
-    def make_rook_move(self, move):
-        from_square_bitboard, to_square_bitboard = self.get_to_from_rook_move(move)
+    def make_rook_move(self, parsed_move):
+        from_square_bitboard, to_square_bitboard = self.get_to_from_parsed_move(parsed_move)
         if from_square_bitboard and to_square_bitboard:
             self.move_rook(from_square_bitboard, to_square_bitboard)
             return 1
@@ -467,8 +749,8 @@ class Board():
             print("not valid")
             return -1
 
-    def make_queen_move(self, move):
-        from_square_bitboard, to_square_bitboard = self.get_to_from_queen_move(move)
+    def make_queen_move(self, parsed_move):
+        from_square_bitboard, to_square_bitboard = self.get_to_from_parsed_move(parsed_move)
         if from_square_bitboard and to_square_bitboard:
             self.move_piece(from_square_bitboard, to_square_bitboard)
             return 1
@@ -476,8 +758,8 @@ class Board():
             print("not valid")
             return -1
 
-    def make_king_move(self, move):
-        from_square_bitboard, to_square_bitboard = self.get_to_from_king_move(move)
+    def make_king_move(self, parsed_move):
+        from_square_bitboard, to_square_bitboard = self.get_to_from_parsed_move(parsed_move)
         if to_square_bitboard:
             self.move_king(from_square_bitboard, to_square_bitboard)
             return 1
@@ -486,340 +768,339 @@ class Board():
             return -1
 
 
-    def make_castle_move(self, move):
-        if move.upper().startswith("O-O-O") or move.startswith("0-0-0"):
-            if self.whites_move:
-                from_square_bitboard = self.bb_white_king
-                to_square_bitboard = 0x0000000000000004  # Queen-side castling
-            else:
-                from_square_bitboard = self.bb_black_king
-                to_square_bitboard = 0x0400000000000000 # King-side castling
-        elif move.upper().startswith("O-O") or move.startswith("0-0"):
-            if self.whites_move:
-                from_square_bitboard = self.bb_white_king
-                to_square_bitboard = 0x0000000000000040  # King-side castling
-            else:
-                from_square_bitboard = self.bb_black_king
-                to_square_bitboard = 0x4000000000000000  # King-side castling
-        if to_square_bitboard & self.king_moves(self.whites_move):
+    def make_castle_move(self, parsed_move):
+        from_square_bitboard, to_square_bitboard = self.get_to_from_parsed_move(parsed_move)
+        if to_square_bitboard:
             self.move_castle(from_square_bitboard, to_square_bitboard)
             return 1
         else:
             print("Not Valid")
             return -1
 
-    def make_algebraic_move(self, move):
-        if move[0] in ('a','b','c','d','e','f','g','h'):
-            return_flag= self.make_pawn_move(move)
+    def make_algebraic_move(self, move, return_fen=True):
+        # With return_fen=False the FEN is not built until current_fen is read, last_fen builds the previous one from a
+        # snapshot when it is read
+        last_fen = self.current_fen if return_fen else self.cached_fen
+        if last_fen is None:
+            last_fen = (self.squares[:], self.whites_move, self.castling_rights, self.en_passant_square, self.halfmove_clock, self.move_number)
+        parsed_move = parse_san(move)
+        if not parsed_move:
+            return_flag=-1
+
+        elif parsed_move[0] == 'P':
+            return_flag= self.make_pawn_move(parsed_move)
 
-        elif move[0] == 'N':
-            return_flag= self.make_knight_move(move)
+        elif parsed_move[0] == 'N':
+            return_flag= self.make_knight_move(parsed_move)
 
-        elif move[0] == 'B':
-            return_flag= self.make_bishop_move(move)
+        elif parsed_move[0] == 'B':
+            return_flag= self.make_bishop_move(parsed_move)
 
-        elif move[0] == 'R':
-            return_flag= self.make_rook_move(move)
+        elif parsed_move[0] == 'R':
+            return_flag= self.make_rook_move(parsed_move)
 
-        elif move[0] == 'Q':
-            return_flag= self.make_queen_move(move)
+        elif parsed_move[0] == 'Q':
+            return_flag= self.make_queen_move(parsed_move)
             
-        elif move[0] == 'K':
-            return_flag= self.make_king_move(move)
+        elif parsed_move[0] == 'K':
+            return_flag= self.make_king_move(parsed_move)
             
-        elif move[0].upper() == 'O' or move[0] == '0':
-            return_flag= self.make_castle_move(move)
-
         else:
-            return_flag=-1
+            return_flag= self.make_castle_move(parsed_move)
         if return_flag ==-1:
             print("Not Valid")
             return -1
-        self.last_fen = self.current_fen
-        self.current_fen = self.export_fen()
-        return self.current_fen
-
-    def get_to_from_pawn_move(self, move, return_bitboard=True):
-        file = ord(move[0]) - ord('a')
-        if '=' in move:
-            promote_peice = move.split('=')[1][0]
-        else:
-            promote_peice=None
-        if move [1] == 'x':
-            to_square = self.alphanum_to_coordinate(move[2:4])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard = Board.FILE_BITBOARDS[file] & self.from_pawn_attacks(to_square_bitboard,self.whites_move) & self.bb_white_pawns
-                to_square_bitboard &= self.bb_black_occupy | self.coordinate_to_bitboard(self.en_passant_square)
-            else:
-                from_square_bitboard = Board.FILE_BITBOARDS[file] & self.from_pawn_attacks(to_square_bitboard,self.whites_move) & self.bb_black_pawns
-                to_square_bitboard &= self.bb_white_occupy | self.coordinate_to_bitboard(self.en_passant_square)
-        else:
-            to_square = self.alphanum_to_coordinate(move[0:2])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard = Board.FILE_BITBOARDS[file] & self.from_pawn_move(to_square_bitboard,self.whites_move) & self.bb_white_pawns
-                to_square_bitboard &= ~self.bb_black_occupy
+        self.last_fen = last_fen
+        if return_fen:
+            return self.current_fen
+        return 1
+
+    def make_move(self, move):
+        from_bb, to_bb, promote = move
+        if from_bb & (self.bb_white_pawns | self.bb_black_pawns):
+            self.move_pawn(from_bb, to_bb, promote)
+        elif from_bb & (self.bb_white_king | self.bb_black_king):
+            if from_bb << 2 == to_bb or from_bb >> 2 == to_bb:
+                self.move_castle(from_bb, to_bb)
             else:
-                from_square_bitboard = Board.FILE_BITBOARDS[file] & self.from_pawn_move(to_square_bitboard,self.whites_move) & self.bb_black_pawns
-                to_square_bitboard &= ~self.bb_white_occupy
-
-        if from_square_bitboard and to_square_bitboard:
-            if return_bitboard:
-                return (from_square_bitboard, to_square_bitboard)
-            return (self.bitboard_to_coordinate(from_square_bitboard), self.bitboard_to_coordinate(to_square_bitboard))
-                    
+                self.move_king(from_bb, to_bb)
+        elif from_bb & (self.bb_white_rooks | self.bb_black_rooks):
+            self.move_rook(from_bb, to_bb)
         else:
-            print("not valid")
-            return -1
-
-    def get_to_from_knight_move(self, move, return_bitboard=True):
-        naked_move, _ = re.subn("[x+#]",'',move)
-        if len(naked_move) == 3:
-            to_square = self.alphanum_to_coordinate(naked_move[1:3])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard =  self.from_knight_move(to_square_bitboard,self.whites_move) & self.bb_white_knights
-            else:
-                from_square_bitboard =  self.from_knight_move(to_square_bitboard,self.whites_move) & self.bb_black_knights
-                
-        elif len(naked_move) == 4:
-            to_square = self.alphanum_to_coordinate(naked_move[2:4])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard =  self.from_knight_move(to_square_bitboard,self.whites_move) & self.bb_white_knights
-            else:
-                from_square_bitboard =  self.from_knight_move(to_square_bitboard,self.whites_move) & self.bb_black_knights
-            if naked_move[1].isdigit():
-                from_square_bitboard&= Board.RANK_BITBOARDS[int(naked_move[1])-1]
-            else:
-                from_square_bitboard&= Board.FILE_BITBOARDS[ord(naked_move[1])-ord('a')]
-                
+            self.move_piece(from_bb, to_bb)
 
-        elif len(naked_move) == 5:
-            to_square = self.alphanum_to_coordinate(naked_move[3:5])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard =  self.from_knight_move(to_square_bitboard,self.whites_move) & self.bb_white_knights
-            else:
-                from_square_bitboard =  self.from_knight_move(to_square_bitboard,self.whites_move) & self.bb_black_knights
-            if naked_move[1].isdigit():
-                from_square_bitboard&= Board.RANK_BITBOARDS[int(naked_move[1])-1] & Board.FILE_BITBOARDS[ord(naked_move[2])-ord('a')]
-            else:
-                from_square_bitboard&= Board.FILE_BITBOARDS[ord(naked_move[1])-ord('a')] & Board.RANK_BITBOARDS[int(naked_move[2])-1]
-        if from_square_bitboard and to_square_bitboard:
-            from_square_bitboard = self.amb_from(from_square_bitboard, to_square_bitboard)
-            if return_bitboard:
-                return (from_square_bitboard, to_square_bitboard)
-            return (self.bitboard_to_coordinate(from_square_bitboard), self.bitboard_to_coordinate(to_square_bitboard))
+    def san_to_move(self, move):
+        parsed_move = parse_san(move)
+        if not parsed_move:
+            return None
+        from_square_bitboard, to_square_bitboard = self.get_to_from_parsed_move(parsed_move)
+        if not (from_square_bitboard and to_square_bitboard):
+            return None
+        return (from_square_bitboard, to_square_bitboard, parsed_move[4])
+
+    @classmethod
+    def from_template(cls, fen=None):
+        # Only the starting position is kept, other FENs are parsed so callers passing every position they visit
+        # don't grow a cache
+        if fen and fen != Board.STARTING_FEN:
+            return cls(fen)
+        if cls.starting_template is None:
+            cls.starting_template = cls(Board.STARTING_FEN)
+        return cls.starting_template.copy()
+
+    def copy(self):
+        # Same position with its own mailbox and an empty undo stack, every other field is an int, str or tuple
+        board = Board.__new__(Board)
+        board.squares = self.squares[:]
+        board.rank_fens = self.rank_fens[:]
+        board.bb_white_pawns = self.bb_white_pawns
+        board.bb_white_knights = self.bb_white_knights
+        board.bb_white_bishops = self.bb_white_bishops
+        board.bb_white_rooks = self.bb_white_rooks
+        board.bb_white_queens = self.bb_white_queens
+        board.bb_white_king = self.bb_white_king
+        board.bb_black_pawns = self.bb_black_pawns
+        board.bb_black_knights = self.bb_black_knights
+        board.bb_black_bishops = self.bb_black_bishops
+        board.bb_black_rooks = self.bb_black_rooks
+        board.bb_black_queens = self.bb_black_queens
+        board.bb_black_king = self.bb_black_king
+        board.bb_white_occupy = self.bb_white_occupy
+        board.bb_black_occupy = self.bb_black_occupy
+        board.bb_occupy = self.bb_occupy
+        board.whites_move = self.whites_move
+        board.castling_rights = self.castling_rights
+        board.en_passant_square = self.en_passant_square
+        board.halfmove_clock = self.halfmove_clock
+        board.move_number = self.move_number
+        board.key = self.key
+        board.undo_stack = []
+        board.cached_fen = self.cached_fen
+        # The copy has no undo record to build the previous FEN from
+        board.previous_fen = None if self.previous_fen is PUSHED_POSITION else self.previous_fen
+        board.init_fen = self.init_fen
+        board.result = self.result
+        return board
+
+    @classmethod
+    def replay(cls, moves, fmt="fen", fen=None):
+        # Plays a list of SAN moves and returns (positions, failure), one entry per move played.
+        # fmt is "fen", "key", "bytes" (see to_bytes) or "code" (the move code of the move, see encode_move),
+        # or a tuple of those for a tuple per move.
+        # failure is None, or (ply, move, reason) for the first move that could not be played
+        formats = (fmt,) if isinstance(fmt, str) else tuple(fmt)
+        for position_format in formats:
+            if position_format not in ("fen", "key", "bytes", "code"):
+                raise ValueError(f"Unknown position format {position_format}")
+        board = cls.from_template(fen)
+        positions = []
+        for ply, move in enumerate(moves):
+            parsed_move = parse_san(move)
+            if not parsed_move:
+                return positions, (ply, move, "unreadable")
+            from_square_bitboard, to_square_bitboard = board.get_to_from_parsed_move(parsed_move)
+            if not (from_square_bitboard and to_square_bitboard):
+                return positions, (ply, move, "illegal")
+            move = (from_square_bitboard, to_square_bitboard, parsed_move[4])
+            code = board.encode_move(move) if "code" in formats else None
+            board.make_move(move)
+            position = []
+            for position_format in formats:
+                if position_format == "fen":
+                    position.append(board.current_fen)
+                elif position_format == "key":
+                    position.append(board.key)
+                elif position_format == "bytes":
+                    position.append(board.to_bytes())
+                else:
+                    position.append(code)
+            positions.append(position[0] if len(formats) == 1 else tuple(position))
+        return positions, None
+
+    def encode_move(self, move):
+        # move code of a (from_bb, to_bb, promote) move in this position, before it is played
+        from_bb, to_bb, promote = move
+        code = (from_bb.bit_length() - 1) | (to_bb.bit_length() - 1) << 6
+        if promote:
+            return code | PROMOTION_PIECES.index(promote.upper()) << 12 | MOVE_PROMOTION << 14
+        if from_bb & (self.bb_white_pawns | self.bb_black_pawns) and to_bb == self.coordinate_to_bitboard(self.en_passant_square):
+            return code | MOVE_EN_PASSANT << 14
+        if from_bb & (self.bb_white_king | self.bb_black_king) and (from_bb << 2 == to_bb or from_bb >> 2 == to_bb):
+            return code | MOVE_CASTLE << 14
+        return code
+
+    def decode_move(self, code):
+        promote = PROMOTION_PIECES[code >> 12 & 0x3] if code >> 14 == MOVE_PROMOTION else None
+        return (1 << (code & 0x3F), 1 << (code >> 6 & 0x3F), promote)
+
+    def move_to_san(self, move):
+        # SAN of a legal (from_bb, to_bb, promote) move in this position, with check and mate marks
+        san = self.san_without_check(move)
+        self.push(move, return_fen=False)
+        san += self.check_mark()
+        self.pop()
+        return san
+
+    def san_without_check(self, move):
+        # move_to_san without the check or mate mark, a caller playing the move anyway adds check_mark() after it
+        from_bb, to_bb, promote = move
+        from_square = from_bb.bit_length() - 1
+        piece = abs(self.squares[from_square])
+        to_alphanum = SQUARE_NAMES[to_bb.bit_length() - 1]
+        capture = to_bb & (self.bb_black_occupy if self.whites_move else self.bb_white_occupy)
+        if piece == 6 and (from_bb << 2 == to_bb or from_bb >> 2 == to_bb):
+            san = "O-O" if to_bb > from_bb else "O-O-O"
+        elif piece == 1:
+            capture = capture or to_bb == self.coordinate_to_bitboard(self.en_passant_square)
+            san = f"{chr(ord('a') + from_square % 8)}x{to_alphanum}" if capture else to_alphanum
+            if promote:
+                san += f"={promote.upper()}"
         else:
-            print("not valid")
-            return -1
-
-    def get_to_from_bishop_move(self, move, return_bitboard=True):
-        naked_move, _ = re.subn("[x+#]",'',move)
-        if len(naked_move) == 3:
-            to_square = self.alphanum_to_coordinate(naked_move[1:3])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard =  self.from_bishop_move(to_square_bitboard,self.whites_move) & self.bb_white_bishops
-            else:
-                from_square_bitboard =  self.from_bishop_move(to_square_bitboard,self.whites_move) & self.bb_black_bishops
-                
-        elif len(naked_move) == 4:
-            to_square = self.alphanum_to_coordinate(naked_move[2:4])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard =  self.from_bishop_move(to_square_bitboard,self.whites_move) & self.bb_white_bishops
-            else:
-                from_square_bitboard =  self.from_bishop_move(to_square_bitboard,self.whites_move) & self.bb_black_bishops
-            if naked_move[1].isdigit():
-                from_square_bitboard&= Board.RANK_BITBOARDS[int(naked_move[1])-1]
-            else:
-                from_square_bitboard&= Board.FILE_BITBOARDS[ord(naked_move[1])-ord('a')]
-                
-
-        elif len(naked_move) == 5:
-            to_square = self.alphanum_to_coordinate(naked_move[3:5])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard =  self.from_bishop_move(to_square_bitboard,self.whites_move) & self.bb_white_bishops
-            else:
-                from_square_bitboard =  self.from_bishop_move(to_square_bitboard,self.whites_move) & self.bb_black_bishops
-            if naked_move[1].isdigit():
-                from_square_bitboard&= Board.RANK_BITBOARDS[int(naked_move[1])-1] & Board.FILE_BITBOARDS[ord(naked_move[2])-ord('a')]
-            else:
-                from_square_bitboard&= Board.FILE_BITBOARDS[ord(naked_move[1])-ord('a')] & Board.RANK_BITBOARDS[int(naked_move[2])-1]
-        if from_square_bitboard and to_square_bitboard:
-            from_square_bitboard = self.amb_from(from_square_bitboard, to_square_bitboard)
-            if return_bitboard:
-                return (from_square_bitboard, to_square_bitboard)
-            return (self.bitboard_to_coordinate(from_square_bitboard), self.bitboard_to_coordinate(to_square_bitboard))
-            
+            same_pieces = self.piece_bitboards(self.whites_move)[piece - 1]
+            # Only pieces attacking the square can be legal alternatives, most moves have none
+            candidates = self.attackers_to(to_bb.bit_length() - 1, self.whites_move) & same_pieces & ~from_bb
+            others = [from_other for from_other, _, _ in self.generate_legal_moves(candidates, to_bb)] if candidates else []
+            disambiguation = ""
+            if others:
+                if not any(other & Board.FILE_BITBOARDS[from_square % 8] for other in others):
+                    disambiguation = chr(ord('a') + from_square % 8)
+                elif not any(other & Board.RANK_BITBOARDS[from_square // 8] for other in others):
+                    disambiguation = str(from_square // 8 + 1)
+                else:
+                    disambiguation = SQUARE_NAMES[from_square]
+            san = f"{Board.NUMBER_TO_PIECE[piece]}{disambiguation}{'x' if capture else ''}{to_alphanum}"
+        return san
+
+    def check_mark(self):
+        # SAN suffix of the move that reached this position, "+" for check, "#" for mate
+        if self.is_king_in_check(self.whites_move):
+            return "+" if self.generate_legal_moves() else "#"
+        return ""
+
+    def piece_bitboards(self, white):
+        if white:
+            return (self.bb_white_pawns, self.bb_white_knights, self.bb_white_bishops, self.bb_white_rooks, self.bb_white_queens, self.bb_white_king)
+        return (self.bb_black_pawns, self.bb_black_knights, self.bb_black_bishops, self.bb_black_rooks, self.bb_black_queens, self.bb_black_king)
+
+    @classmethod
+    def decode_moves(cls, codes, fmt="san", fen=None):
+        # SAN or UCI strings of a sequence of move codes played from fen
+        if fmt == "uci":
+            return [move_code_to_uci(code) for code in codes]
+        board = cls.from_template(fen)
+        moves = []
+        for code in codes:
+            move = board.decode_move(code)
+            san = board.san_without_check(move)
+            board.make_move(move)
+            moves.append(san + board.check_mark())
+        return moves
+
+    def push(self, move, return_fen=True):
+        # move is SAN or a (from_bb, to_bb, promote) tuple, undone again with pop()
+        if isinstance(move, str):
+            move = self.san_to_move(move)
+            if move is None:
+                print("Not Valid")
+                return -1
+        last_fen = self.current_fen if return_fen else self.cached_fen
+        # The undo record holds the squares the move changes with the pieces that were on them (the moved piece, the
+        # captured one, the rook of a castling move) and the FENs of the two ranks it touches, next to the state fields
+        from_bb, to_bb, _ = move
+        from_square = from_bb.bit_length() - 1
+        to_square = to_bb.bit_length() - 1
+        squares = self.squares
+        piece = squares[from_square]
+        if (piece == 1 or piece == -1) and to_bb == self.coordinate_to_bitboard(self.en_passant_square):
+            captured_square = to_square - 8 if piece == 1 else to_square + 8
+            changed = ((from_square, piece), (to_square, 0), (captured_square, squares[captured_square]))
+        elif (piece == 6 or piece == -6) and (from_bb << 2 == to_bb or from_bb >> 2 == to_bb):
+            rook_from, rook_to = CASTLING_ROOK_SQUARES[to_square]
+            changed = ((from_square, piece), (to_square, 0), (rook_from, squares[rook_from]), (rook_to, 0))
         else:
-            print("not valid")
-            return -1
-
-    def get_to_from_rook_move(self, move, return_bitboard=True):
-        naked_move, _ = re.subn("[x+#]",'',move)
-        if len(naked_move) == 3:
-            to_square = self.alphanum_to_coordinate(naked_move[1:3])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard =  self.from_rook_move(to_square_bitboard,self.whites_move) & self.bb_white_rooks
-                    
-            else:
-                from_square_bitboard =  self.from_rook_move(to_square_bitboard,self.whites_move) & self.bb_black_rooks
-                    
-                
-        elif len(naked_move) == 4:
-            to_square = self.alphanum_to_coordinate(naked_move[2:4])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard =  self.from_rook_move(to_square_bitboard,self.whites_move) & self.bb_white_rooks
-                    
-            else:
-                from_square_bitboard = self.from_rook_move(to_square_bitboard,self.whites_move) & self.bb_black_rooks
-                    
-            if naked_move[1].isdigit():
-                from_square_bitboard&= Board.RANK_BITBOARDS[int(naked_move[1])-1]
-            else:
-                from_square_bitboard&= Board.FILE_BITBOARDS[ord(naked_move[1])-ord('a')]
-                
+            changed = ((from_square, piece), (to_square, squares[to_square]))
+        from_rank, to_rank = from_square >> 3, to_square >> 3
+        self.undo_stack.append((
+            move, changed, from_rank, self.rank_fens[from_rank], to_rank, self.rank_fens[to_rank],
+            self.castling_rights, self.en_passant_square, self.halfmove_clock, self.move_number, self.key,
+            self.previous_fen, last_fen))
+        self.make_move(move)
+        # Without a FEN, last_fen builds it from the undo record when it is read
+        self.previous_fen = PUSHED_POSITION if last_fen is None else last_fen
+        if return_fen:
+            return self.current_fen
+        return 1
+
+    def pop(self):
+        (move, changed, from_rank, from_rank_fen, to_rank, to_rank_fen,
+         self.castling_rights, self.en_passant_square, self.halfmove_clock, self.move_number, self.key,
+         self.previous_fen, self.cached_fen) = self.undo_stack.pop()
+        squares = self.squares
+        for square, piece in changed:
+            current = squares[square]
+            if current != piece:
+                bit = 1 << square
+                if current:
+                    name = PIECE_BITBOARD_NAMES[current]
+                    setattr(self, name, getattr(self, name) ^ bit)
+                if piece:
+                    name = PIECE_BITBOARD_NAMES[piece]
+                    setattr(self, name, getattr(self, name) ^ bit)
+                squares[square] = piece
+        self.rank_fens[to_rank] = to_rank_fen
+        self.rank_fens[from_rank] = from_rank_fen
+        self.bb_white_occupy = self.bb_white_pawns | self.bb_white_knights | self.bb_white_bishops | self.bb_white_rooks | self.bb_white_queens | self.bb_white_king
+        self.bb_black_occupy = self.bb_black_pawns | self.bb_black_knights | self.bb_black_bishops | self.bb_black_rooks | self.bb_black_queens | self.bb_black_king
+        self.bb_occupy = self.bb_white_occupy | self.bb_black_occupy
+        self.whites_move = not self.whites_move
+        return move
 
-        elif len(naked_move) == 5:
-            to_square = self.alphanum_to_coordinate(naked_move[3:5])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard =  self.from_rook_move(to_square_bitboard,self.whites_move) & self.bb_white_rooks
-            else:
-                from_square_bitboard =  self.from_rook_move(to_square_bitboard,self.whites_move) & self.bb_black_rooks
-            if naked_move[1].isdigit():
-                from_square_bitboard&= Board.RANK_BITBOARDS[int(naked_move[1])-1] & Board.FILE_BITBOARDS[ord(naked_move[2])-ord('a')]
-            else:
-                from_square_bitboard&= Board.FILE_BITBOARDS[ord(naked_move[1])-ord('a')] & Board.RANK_BITBOARDS[int(naked_move[2])-1]
+    def get_to_from_parsed_move(self, parsed_move):
+        # (from, to) bitboards of a parse_san result in this position, either is 0 when the move can't be played
+        piece, to_square_bitboard, from_mask, capture, _ = parsed_move
+        white = self.whites_move
+        match piece:
+            case 'P':
+                if capture:
+                    from_square_bitboard = self.from_pawn_attacks(to_square_bitboard, white) & (self.bb_white_pawns if white else self.bb_black_pawns)
+                    to_square_bitboard &= (self.bb_black_occupy if white else self.bb_white_occupy) | self.coordinate_to_bitboard(self.en_passant_square)
+                else:
+                    from_square_bitboard = self.from_pawn_move(to_square_bitboard, white)
+                    to_square_bitboard &= ~(self.bb_black_occupy if white else self.bb_white_occupy)
+            case 'N':
+                from_square_bitboard = self.from_knight_move(to_square_bitboard, white)
+            case 'B':
+                from_square_bitboard = self.from_bishop_move(to_square_bitboard, white)
+            case 'R':
+                from_square_bitboard = self.from_rook_move(to_square_bitboard, white)
+            case 'Q':
+                from_square_bitboard = self.from_queen_move(to_square_bitboard, white)
+            case 'K':
+                return (self.bb_white_king if white else self.bb_black_king), to_square_bitboard & self.king_moves(white)
+            case 'O-O':
+                if white:
+                    return self.bb_white_king, 0x0000000000000040 & self.king_moves(white)
+                return self.bb_black_king, 0x4000000000000000 & self.king_moves(white)
+            case 'O-O-O':
+                if white:
+                    return self.bb_white_king, 0x0000000000000004 & self.king_moves(white)
+                return self.bb_black_king, 0x0400000000000000 & self.king_moves(white)
+        from_square_bitboard &= from_mask
         if from_square_bitboard and to_square_bitboard:
             from_square_bitboard = self.amb_from(from_square_bitboard, to_square_bitboard)
-            if return_bitboard:
-                return (from_square_bitboard, to_square_bitboard)
-            return (self.bitboard_to_coordinate(from_square_bitboard), self.bitboard_to_coordinate(to_square_bitboard))
-            
-        else:
-            print("not valid")
-            return -1
-
-    def get_to_from_queen_move(self, move, return_bitboard=True):
-        naked_move, _ = re.subn("[x+#]",'',move)
-        if len(naked_move) == 3:
-            to_square = self.alphanum_to_coordinate(naked_move[1:3])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard =  self.from_queen_move(to_square_bitboard,self.whites_move) & self.bb_white_queens
-            else:
-                from_square_bitboard = self.from_queen_move(to_square_bitboard,self.whites_move) & self.bb_black_queens
-              
-        elif len(naked_move) == 4:
-            to_square = self.alphanum_to_coordinate(naked_move[2:4])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard = self.from_queen_move(to_square_bitboard,self.whites_move) & self.bb_white_queens
-            else:
-                from_square_bitboard = self.from_queen_move(to_square_bitboard,self.whites_move) & self.bb_black_queens
-            if naked_move[1].isdigit():
-                from_square_bitboard&= Board.RANK_BITBOARDS[int(naked_move[1])-1]
-            else:
-                from_square_bitboard&= Board.FILE_BITBOARDS[ord(naked_move[1])-ord('a')]
-                
+        return from_square_bitboard, to_square_bitboard
 
-        elif len(naked_move) == 5:
-            to_square = self.alphanum_to_coordinate(naked_move[3:5])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square)
-            if self.whites_move:
-                from_square_bitboard = self.from_queen_move(to_square_bitboard,self.whites_move) & self.bb_white_queens
-            else:
-                from_square_bitboard = self.from_queen_move(to_square_bitboard,self.whites_move) & self.bb_black_queens
-            if naked_move[1].isdigit():
-                from_square_bitboard&= Board.RANK_BITBOARDS[int(naked_move[1])-1] & Board.FILE_BITBOARDS[ord(naked_move[2])-ord('a')]
-            else:
-                from_square_bitboard&= Board.FILE_BITBOARDS[ord(naked_move[1])-ord('a')] & Board.RANK_BITBOARDS[int(naked_move[2])-1]
-        if from_square_bitboard and to_square_bitboard:
-            from_square_bitboard = self.amb_from(from_square_bitboard, to_square_bitboard)
-            if return_bitboard:
-                return (from_square_bitboard, to_square_bitboard)
-            return (self.bitboard_to_coordinate(from_square_bitboard), self.bitboard_to_coordinate(to_square_bitboard))
-            
-        else:
-            print("not valid")
-            return -1
-    def get_to_from_king_move(self, move, return_bitboard=True):
-        naked_move, _ = re.subn("[x+#]",'',move)
-        if len(naked_move) == 3:
-            to_square = self.alphanum_to_coordinate(naked_move[1:3])
-            to_square_bitboard = self.coordinate_to_bitboard(to_square) & self.king_moves(self.whites_move)
-            if self.whites_move:
-                from_square_bitboard = self.bb_white_king
-            else:
-                from_square_bitboard = self.bb_black_king
-            if to_square_bitboard:
+    def get_to_from_square_algebraic_move(self, move, return_bitboard=True, quiet=False):
+        parsed_move = parse_san(move)
+        if parsed_move:
+            from_square_bitboard, to_square_bitboard = self.get_to_from_parsed_move(parsed_move)
+            if from_square_bitboard and to_square_bitboard:
                 if return_bitboard:
                     return (from_square_bitboard, to_square_bitboard)
                 return (self.bitboard_to_coordinate(from_square_bitboard), self.bitboard_to_coordinate(to_square_bitboard))
-            else:
-                print("not valid")
-                return -1
-        else:
-            print("AHHHHHHHH")
-            return -1
-    def get_to_from_castle_move(self, move, return_bitboard=True):
-        if move.upper().startswith("O-O-O") or move.startswith("0-0-0"):
-            if self.whites_move:
-                from_square_bitboard = self.bb_white_king
-                to_square_bitboard = 0x0000000000000004  # Queen-side castling
-            else:
-                from_square_bitboard = self.bb_black_king
-                to_square_bitboard = 0x0400000000000000 
-        elif move.upper().startswith("O-O") or move.startswith("0-0"):
-            if self.whites_move:
-                from_square_bitboard = self.bb_white_king
-                to_square_bitboard = 0x0000000000000040  # King-side castling
-            else:
-                from_square_bitboard = self.bb_black_king
-                to_square_bitboard = 0x4000000000000000
-        if to_square_bitboard & self.king_moves(self.whites_move):
-            if return_bitboard:
-                return (from_square_bitboard, to_square_bitboard)
-            return (self.bitboard_to_coordinate(from_square_bitboard), self.bitboard_to_coordinate(to_square_bitboard))
-            
-        else:
-            print("Not Valid")
-            return -1
-
-    def get_to_from_square_algebraic_move(self, move, return_bitboard=True):
-        
-        if move[0] in ('a','b','c','d','e','f','g','h'):
-            return self.get_to_from_pawn_move(move, return_bitboard)
-
-        elif move[0] == 'N':
-            return self.get_to_from_knight_move(move, return_bitboard)
-
-        elif move[0] == 'B':
-            return self.get_to_from_bishop_move(move, return_bitboard)
-
-        elif move[0] == 'R':
-            return self.get_to_from_rook_move(move, return_bitboard)
-
-        elif move[0] == 'Q':
-            return self.get_to_from_queen_move(move, return_bitboard)
-
-        elif move[0] == 'K':
-            return self.get_to_from_king_move(move, return_bitboard)
-
-        elif move[0].upper() == 'O' or move[0] == '0':
-            return self.get_to_from_castle_move(move, return_bitboard)
-            
-        else:
+        if not quiet:
             print("Not Valid")
-            return -1
+        return -1
 
     def display_bitboards(self):
         print("White Pawn BitBoard:")
@@ -940,28 +1221,12 @@ class Board():
         return attack_bitboard | self.coordinate_to_bitboard(self.en_passant_square)
 
     def from_pawn_attacks(self, position, white=True):
-
-        attack_bitboard = 0
-        if not white:
-            # Left attacks
-            left_attacks = (position & 0xFEFEFEFEFEFEFEFE) << 7
-            attack_bitboard |= left_attacks 
-
-            # Right attacks
-            right_attacks = (position & 0x7F7F7F7F7F7F7F7F) << 9
-            attack_bitboard |= right_attacks
-
-            attack_bitboard &= (self.bb_black_occupy| self.coordinate_to_bitboard(self.en_passant_square))
-        else:
-            # Left attacks
-            left_attacks = (position & 0xFEFEFEFEFEFEFEFE) >> 9
-            attack_bitboard |= left_attacks
-
-            # Right attacks
-            right_attacks = (position & 0x7F7F7F7F7F7F7F7F) >> 7
-            attack_bitboard |= right_attacks
+        # A white pawn attacks position from the squares a black pawn on position would attack
+        attack_bitboard = PAWN_ATTACKS[not white][position.bit_length() - 1]
+        if white:
             attack_bitboard &= (self.bb_white_occupy | self.coordinate_to_bitboard(self.en_passant_square))
-
+        else:
+            attack_bitboard &= (self.bb_black_occupy| self.coordinate_to_bitboard(self.en_passant_square))
         return attack_bitboard 
 
     def pawn_moves(self, white):
@@ -999,80 +1264,18 @@ class Board():
         else:
             rook_bitboard = self.bb_white_rooks if white else self.bb_black_rooks
         self_occupy = self.bb_white_occupy if white else self.bb_black_occupy
-        # Generate horizontal (rank) attacks
-        left_attacks = rook_bitboard & 0xFEFEFEFEFEFEFEFE
-        while left_attacks & 0xFEFEFEFEFEFEFEFE != 0:
-            left_attacks >>= 1
-            
-            attack_bitboard |= left_attacks
-            left_attacks &= ~self.bb_occupy
-
-        # Generate horizontal (rank) attacks to the right
-        right_attacks = rook_bitboard & 0x7F7F7F7F7F7F7F7F
-        while right_attacks & 0x7F7F7F7F7F7F7F7F != 0:
-            right_attacks <<= 1
-            
-            attack_bitboard |= right_attacks
-            right_attacks &= ~self.bb_occupy
-
-        # Generate vertical (file) attacks upward
-        up_attacks = rook_bitboard & 0x00FFFFFFFFFFFFFF
-        while up_attacks & 0x00FFFFFFFFFFFFFF != 0:
-            up_attacks <<= 8
-            
-            attack_bitboard |= up_attacks
-            up_attacks &= ~self.bb_occupy
-
-        # Generate vertical (file) attacks downward
-        down_attacks = rook_bitboard & 0xFFFFFFFFFFFFFF00
-        while down_attacks & 0xFFFFFFFFFFFFFF00  != 0:
-            down_attacks >>= 8
-            
-            attack_bitboard |= down_attacks
-            down_attacks &= ~self.bb_occupy
-
+        while rook_bitboard:
+            square_bitboard = rook_bitboard & -rook_bitboard
+            attack_bitboard |= rook_attacks(square_bitboard.bit_length() - 1, self.bb_occupy)
+            rook_bitboard ^= square_bitboard
         return attack_bitboard & ~self_occupy
 
     def from_rook_move(self, position, white, queen = False):
-        attack_bitboard = 0
         if queen:
             rook_bitboard = self.bb_white_queens if white else self.bb_black_queens
         else:
             rook_bitboard = self.bb_white_rooks if white else self.bb_black_rooks
-        # Generate horizontal (rank) attacks
-        left_attacks = position & 0xFEFEFEFEFEFEFEFE
-        while left_attacks & 0xFEFEFEFEFEFEFEFE != 0:
-            left_attacks >>= 1
-            
-            attack_bitboard |= left_attacks
-            left_attacks &= ~self.bb_occupy
-
-        # Generate horizontal (rank) attacks to the right
-        right_attacks = position & 0x7F7F7F7F7F7F7F7F
-        while right_attacks & 0x7F7F7F7F7F7F7F7F != 0:
-            right_attacks <<= 1
-            
-            attack_bitboard |= right_attacks
-            right_attacks &= ~self.bb_occupy
-
-        # Generate vertical (file) attacks  upward
-        up_attacks = position & 0x00FFFFFFFFFFFFFF
-        while up_attacks & 0x00FFFFFFFFFFFFFF != 0:
-            up_attacks <<= 8
-            
-            attack_bitboard |= up_attacks
-            up_attacks &= ~self.bb_occupy
-
-        # Generate vertical (file) attacks downward
-        down_attacks = position & 0xFFFFFFFFFFFFFF00
-        while down_attacks & 0xFFFFFFFFFFFFFF00  != 0:
-            down_attacks >>= 8
-            
-            attack_bitboard |= down_attacks
-            down_attacks &= ~self.bb_occupy
-
-        attack_bitboard &= rook_bitboard
-        return attack_bitboard
+        return rook_attacks(position.bit_length() - 1, self.bb_occupy) & rook_bitboard
 
     def bishop_moves(self, white, queen = False):
         attack_bitboard = 0
@@ -1081,73 +1284,18 @@ class Board():
         else:
             bishop_bitboard = self.bb_white_bishops if white else self.bb_black_bishops
         self_occupy = self.bb_white_occupy if white else self.bb_black_occupy
-        # Generate attacks along the diagonals (up-right)
-        up_left_attacks = bishop_bitboard & 0x00FEFEFEFEFEFEFE
-        while up_left_attacks & 0x00FEFEFEFEFEFEFE != 0:
-            up_left_attacks = (up_left_attacks << 7) 
-            attack_bitboard |= up_left_attacks
-            up_left_attacks &= ~self.bb_occupy & 0x00FEFEFEFEFEFEFE
-
-        # Generate attacks along the diagonals (up-left)
-        up_right_attacks = bishop_bitboard & 0x007F7F7F7F7F7F7F
-        while up_right_attacks & 0x007F7F7F7F7F7F7F != 0:
-            up_right_attacks = (up_right_attacks << 9)
-            attack_bitboard |= up_right_attacks
-            up_right_attacks &= ~self.bb_occupy & 0x007F7F7F7F7F7F7F
-
-        # Generate attacks along the diagonals (down-left)
-        down_left_attacks = bishop_bitboard & 0xFEFEFEFEFEFEFE00
-        while down_left_attacks & 0xFEFEFEFEFEFEFE00 != 0:
-            down_left_attacks = (down_left_attacks >> 9) 
-            attack_bitboard |= down_left_attacks
-            down_left_attacks &= ~self.bb_occupy & 0xFEFEFEFEFEFEFE00
-
-        # Generate attacks along the diagonals (down-right)
-        down_right_attacks = bishop_bitboard & 0x7F7F7F7F7F7F7F00
-        while down_right_attacks & 0x7F7F7F7F7F7F7F00 != 0:
-            down_right_attacks = (down_right_attacks >> 7) 
-            attack_bitboard |= down_right_attacks
-            down_right_attacks &= ~self.bb_occupy & 0x7F7F7F7F7F7F7F00
-
+        while bishop_bitboard:
+            square_bitboard = bishop_bitboard & -bishop_bitboard
+            attack_bitboard |= bishop_attacks(square_bitboard.bit_length() - 1, self.bb_occupy)
+            bishop_bitboard ^= square_bitboard
         return attack_bitboard & ~self_occupy
 
     def from_bishop_move(self, position, white, queen=False):
-
-        attack_bitboard = 0
         if queen:
             bishop_bitboard = self.bb_white_queens if white else self.bb_black_queens
         else:
             bishop_bitboard = self.bb_white_bishops if white else self.bb_black_bishops
-        # Generate attacks along the diagonals (up-right)
-        up_left_attacks = position & 0x00FEFEFEFEFEFEFE
-        while up_left_attacks & 0x00FEFEFEFEFEFEFE != 0:
-            up_left_attacks = (up_left_attacks << 7) 
-            attack_bitboard |= up_left_attacks
-            up_left_attacks &= ~self.bb_occupy & 0x00FEFEFEFEFEFEFE
-            
-        # Generate attacks along the diagonals (up-left)
-        up_right_attacks = position & 0x007F7F7F7F7F7F7F
-        while up_right_attacks & 0x007F7F7F7F7F7F7F != 0:
-            up_right_attacks = (up_right_attacks << 9)
-            attack_bitboard |= up_right_attacks
-            up_right_attacks &= ~self.bb_occupy & 0x00FEFEFEFEFEFEFE
-
-        # Generate attacks along the diagonals (down-left)
-        down_left_attacks = position & 0xFEFEFEFEFEFEFE00
-        while down_left_attacks & 0xFEFEFEFEFEFEFE00 != 0:
-            down_left_attacks = (down_left_attacks >> 9) 
-            attack_bitboard |= down_left_attacks
-            down_left_attacks &= ~self.bb_occupy & 0xFEFEFEFEFEFEFE00
-
-        # Generate attacks along the diagonals (down-right)
-        down_right_attacks = position & 0x7F7F7F7F7F7F7F00
-        while down_right_attacks & 0x7F7F7F7F7F7F7F00 != 0:
-            down_right_attacks = (down_right_attacks >> 7) 
-            attack_bitboard |= down_right_attacks
-            down_right_attacks &= ~self.bb_occupy & 0x7F7F7F7F7F7F7F00
-
-        attack_bitboard &= bishop_bitboard
-        return attack_bitboard
+        return bishop_attacks(position.bit_length() - 1, self.bb_occupy) & bishop_bitboard
 
     def queen_moves(self, white):
         return self.rook_moves(white,queen=True) | self.bishop_moves(white,queen=True)
@@ -1161,40 +1309,21 @@ class Board():
 
         knight_bitboard = self.bb_white_knights if white else self.bb_black_knights
         self_occupy = self.bb_white_occupy if white else self.bb_black_occupy
-        attack_bitboard = (((knight_bitboard & 0xFCFCFCFCFCFCFC00) >> 10) #left 2 down A 
-                        | ((knight_bitboard & 0x003F3F3F3F3F3F3F) << 10) #right2 up  A
-                        | ((knight_bitboard & 0x3F3F3F3F3F3F3F00) >> 6) #right 2 down A
-                        | ((knight_bitboard & 0x00FCFCFCFCFCFCFC) << 6) #left2 up  A
-                        | ((knight_bitboard & 0x7F7F7F7F7F7F0000) >> 15) #down 2 right  A
-                        | ((knight_bitboard & 0x0000FEFEFEFEFEFE) << 15) #up2 left  A
-                        | ((knight_bitboard & 0xFEFEFEFEFEFE0000) >> 17) #down 2 left
-                        | ((knight_bitboard & 0x00007F7F7F7F7F7F) << 17)) #up2 right
+        attack_bitboard = 0
+        while knight_bitboard:
+            square_bitboard = knight_bitboard & -knight_bitboard
+            attack_bitboard |= KNIGHT_ATTACKS[square_bitboard.bit_length() - 1]
+            knight_bitboard ^= square_bitboard
         return attack_bitboard & ~self_occupy
 
     def from_knight_move (self, position , white= True):
         knight_bitboard = self.bb_white_knights if white else self.bb_black_knights
-        attack_bitboard = (((position & 0xFCFCFCFCFCFCFC00) >> 10) #left 2 down A
-                         | ((position & 0x003F3F3F3F3F3F3F) << 10) #right2 up  A
-                         | ((position & 0x3F3F3F3F3F3F3F00) >> 6) #right 2 down A
-                         | ((position & 0x00FCFCFCFCFCFCFC) << 6) #left2 up  A
-                         | ((position & 0x7F7F7F7F7F7F0000) >> 15) #down 2 right  A
-                         | ((position & 0x0000FEFEFEFEFEFE) << 15) #up2 left  A
-                         | ((position & 0xFEFEFEFEFEFE0000) >> 17) #down 2 left
-                         | ((position & 0x00007F7F7F7F7F7F) << 17)) #up2 right
-        attack_bitboard &= knight_bitboard
-        return attack_bitboard
+        return KNIGHT_ATTACKS[position.bit_length() - 1] & knight_bitboard
 
     def king_moves(self, white = True):
         king_bitboard = self.bb_white_king if white else self.bb_black_king
         self_occupy = self.bb_white_occupy if white else self.bb_black_occupy
-        attack_bitboard = (king_bitboard & 0xFEFEFEFEFEFEFEFE) >> 1  # left
-        attack_bitboard |= (king_bitboard & 0x7F7F7F7F7F7F7F7F) << 1  # right
-        attack_bitboard |= (king_bitboard & 0x00FFFFFFFFFFFFFF) << 8  # Up
-        attack_bitboard |= (king_bitboard & 0xFFFFFFFFFFFFFF00) >> 8  # Down
-        attack_bitboard |= (king_bitboard & 0x7F7F7F7F7F7F7F00) >> 7  # Down Right
-        attack_bitboard |= (king_bitboard & 0x00FEFEFEFEFEFEFE) << 7  # Up left
-        attack_bitboard |= (king_bitboard & 0x007F7F7F7F7F7F7F) << 9  # Up Right
-        attack_bitboard |= (king_bitboard & 0xFEFEFEFEFEFEFE00) >> 9  # Down Left
+        attack_bitboard = KING_ATTACKS[king_bitboard.bit_length() - 1] if king_bitboard else 0
         
         if white:
             # Check if white king-side castling is possible
@@ -1215,15 +1344,152 @@ class Board():
 
         return attack_bitboard & ~self_occupy
 
+    def attackers_to(self, square, by_white, occupancy=None):
+        # Pieces of the given side attacking square, found by looking outwards from the square
+        if occupancy is None:
+            occupancy = self.bb_occupy
+        if by_white:
+            pawns, knights, king = self.bb_white_pawns, self.bb_white_knights, self.bb_white_king
+            rooks = self.bb_white_rooks | self.bb_white_queens
+            bishops = self.bb_white_bishops | self.bb_white_queens
+        else:
+            pawns, knights, king = self.bb_black_pawns, self.bb_black_knights, self.bb_black_king
+            rooks = self.bb_black_rooks | self.bb_black_queens
+            bishops = self.bb_black_bishops | self.bb_black_queens
+        # A pawn attacks square from where a pawn of the other color on square would attack
+        return ((PAWN_ATTACKS[not by_white][square] & pawns)
+                | (KNIGHT_ATTACKS[square] & knights)
+                | (KING_ATTACKS[square] & king)
+                | (rook_attacks(square, occupancy) & rooks)
+                | (bishop_attacks(square, occupancy) & bishops))
+
     def is_positions_in_check(self, positions, white):
-        if white:
-            return (positions & (self.pawn_attacks(white = False) | self.knight_moves(white = False) | self.bishop_moves(white = False) | self.rook_moves(white = False) | self.queen_moves(white = False))) != 0 
-        return (positions & (self.pawn_attacks(white = True) | self.knight_moves(white = True) | self.bishop_moves(white = True) | self.rook_moves(white = True) | self.queen_moves(white = True))) != 0
+        for square_bitboard in self.separate_bitboards(positions):
+            if self.attackers_to(square_bitboard.bit_length() - 1, not white):
+                return True
+        return False
 
     def is_king_in_check(self, white=True):
+        king_bitboard = self.bb_white_king if white else self.bb_black_king
+        return king_bitboard != 0 and self.attackers_to(king_bitboard.bit_length() - 1, not white) != 0
+
+    def attacked_squares(self, white, occupancy):
+        # Every square the given side attacks, defended pieces included, with sliders blocked by occupancy
         if white:
-            return (self.bb_white_king & (self.pawn_attacks(white = False) | self.knight_moves(white = False) | self.bishop_moves(white = False) | self.rook_moves(white = False) | self.queen_moves(white = False))) != 0 
-        return (self.bb_black_king & (self.pawn_attacks(white = True) | self.knight_moves(white = True) | self.bishop_moves(white = True) | self.rook_moves(white = True) | self.queen_moves(white = True))) != 0
+            pawns, knights, king = self.bb_white_pawns, self.bb_white_knights, self.bb_white_king
+            rooks = self.bb_white_rooks | self.bb_white_queens
+            bishops = self.bb_white_bishops | self.bb_white_queens
+            attack_bitboard = ((pawns & 0xFEFEFEFEFEFEFEFE) << 7 | (pawns & 0x7F7F7F7F7F7F7F7F) << 9) & FULL_BITBOARD
+        else:
+            pawns, knights, king = self.bb_black_pawns, self.bb_black_knights, self.bb_black_king
+            rooks = self.bb_black_rooks | self.bb_black_queens
+            bishops = self.bb_black_bishops | self.bb_black_queens
+            attack_bitboard = (pawns & 0xFEFEFEFEFEFEFEFE) >> 9 | (pawns & 0x7F7F7F7F7F7F7F7F) >> 7
+        if king:
+            attack_bitboard |= KING_ATTACKS[king.bit_length() - 1]
+        for square_bitboard in self.separate_bitboards(knights):
+            attack_bitboard |= KNIGHT_ATTACKS[square_bitboard.bit_length() - 1]
+        for square_bitboard in self.separate_bitboards(rooks):
+            attack_bitboard |= rook_attacks(square_bitboard.bit_length() - 1, occupancy)
+        for square_bitboard in self.separate_bitboards(bishops):
+            attack_bitboard |= bishop_attacks(square_bitboard.bit_length() - 1, occupancy)
+        return attack_bitboard
+
+    def generate_legal_moves(self, from_mask=FULL_BITBOARD, to_mask=FULL_BITBOARD):
+        # Legal moves as (from_bb, to_bb, promote) tuples, optionally limited to from/to squares
+        white = self.whites_move
+        if white:
+            own_occupy, enemy_occupy = self.bb_white_occupy, self.bb_black_occupy
+            king, pawns, knights = self.bb_white_king, self.bb_white_pawns, self.bb_white_knights
+            bishops, rooks, queens = self.bb_white_bishops, self.bb_white_rooks, self.bb_white_queens
+            enemy_pawns, enemy_knights = self.bb_black_pawns, self.bb_black_knights
+            enemy_rooks = self.bb_black_rooks | self.bb_black_queens
+            enemy_bishops = self.bb_black_bishops | self.bb_black_queens
+        else:
+            own_occupy, enemy_occupy = self.bb_black_occupy, self.bb_white_occupy
+            king, pawns, knights = self.bb_black_king, self.bb_black_pawns, self.bb_black_knights
+            bishops, rooks, queens = self.bb_black_bishops, self.bb_black_rooks, self.bb_black_queens
+            enemy_pawns, enemy_knights = self.bb_white_pawns, self.bb_white_knights
+            enemy_rooks = self.bb_white_rooks | self.bb_white_queens
+            enemy_bishops = self.bb_white_bishops | self.bb_white_queens
+        occupy = self.bb_occupy
+        king_square = king.bit_length() - 1
+        moves = []
+
+        checkers = self.attackers_to(king_square, not white, occupy)
+
+        pinned = 0
+        snipers = (rook_attacks(king_square, 0) & enemy_rooks) | (bishop_attacks(king_square, 0) & enemy_bishops)
+        for sniper in self.separate_bitboards(snipers):
+            blockers = BETWEEN[king_square][sniper.bit_length() - 1] & occupy
+            if blockers and (blockers & (blockers - 1)) == 0 and blockers & own_occupy:
+                pinned |= blockers
+
+        if king & from_mask:
+            # Sliders see through the king so it can't step back along the checking line
+            danger = self.attacked_squares(not white, occupy ^ king)
+            for to_bb in self.separate_bitboards(KING_ATTACKS[king_square] & ~own_occupy & ~danger & to_mask):
+                moves.append((king, to_bb, None))
+            if not checkers:
+                if white:
+                    castles = ((Board.WHITE_KING_CASTLE, 0x0000000000000060, 0x0000000000000060, 0x0000000000000040),
+                               (Board.WHITE_QUEEN_CASTLE, 0x000000000000000E, 0x000000000000000C, 0x0000000000000004))
+                else:
+                    castles = ((Board.BLACK_KING_CASTLE, 0x6000000000000000, 0x6000000000000000, 0x4000000000000000),
+                               (Board.BLACK_QUEEN_CASTLE, 0x0E00000000000000, 0x0C00000000000000, 0x0400000000000000))
+                for right, empty_path, king_path, to_bb in castles:
+                    if self.castling_rights & right and not occupy & empty_path and not danger & king_path and to_bb & to_mask:
+                        moves.append((king, to_bb, None))
+
+        if checkers & (checkers - 1):
+            return moves
+        if checkers:
+            target_mask = (checkers | BETWEEN[king_square][checkers.bit_length() - 1]) & to_mask
+        else:
+            target_mask = to_mask
+        target_mask &= ~own_occupy
+
+        for from_bb in self.separate_bitboards(knights & ~pinned & from_mask):
+            for to_bb in self.separate_bitboards(KNIGHT_ATTACKS[from_bb.bit_length() - 1] & target_mask):
+                moves.append((from_bb, to_bb, None))
+
+        for slider_bitboard, slider_attacks in ((bishops | queens, bishop_attacks), (rooks | queens, rook_attacks)):
+            for from_bb in self.separate_bitboards(slider_bitboard & from_mask):
+                from_square = from_bb.bit_length() - 1
+                targets = slider_attacks(from_square, occupy) & target_mask
+                if from_bb & pinned:
+                    targets &= LINE[king_square][from_square]
+                for to_bb in self.separate_bitboards(targets):
+                    moves.append((from_bb, to_bb, None))
+
+        en_passant_bb = self.coordinate_to_bitboard(self.en_passant_square)
+        for from_bb in self.separate_bitboards(pawns & from_mask):
+            from_square = from_bb.bit_length() - 1
+            push_bb = from_bb << 8 if white else from_bb >> 8
+            targets = 0
+            if not push_bb & occupy:
+                targets = push_bb
+                double_push_bb = push_bb << 8 if white else push_bb >> 8
+                if from_bb & (0x000000000000FF00 if white else 0x00FF000000000000) and not double_push_bb & occupy:
+                    targets |= double_push_bb
+            targets = (targets | (PAWN_ATTACKS[white][from_square] & enemy_occupy)) & target_mask
+            if from_bb & pinned:
+                targets &= LINE[king_square][from_square]
+            for to_bb in self.separate_bitboards(targets):
+                if to_bb & 0xFF000000000000FF:
+                    for promote in ('Q', 'R', 'B', 'N'):
+                        moves.append((from_bb, to_bb, promote))
+                else:
+                    moves.append((from_bb, to_bb, None))
+
+            if PAWN_ATTACKS[white][from_square] & en_passant_bb & to_mask:
+                # Check the position after the capture directly, this covers pins along the rank of both pawns
+                captured_bb = en_passant_bb >> 8 if white else en_passant_bb << 8
+                after_occupy = (occupy ^ from_bb ^ captured_bb) | en_passant_bb
+                if not (rook_attacks(king_square, after_occupy) & enemy_rooks or bishop_attacks(king_square, after_occupy) & enemy_bishops
+                        or checkers & (enemy_knights | enemy_pawns) & ~captured_bb):
+                    moves.append((from_bb, en_passant_bb, None))
+        return moves
 
     def play_input(self):
         while self.result == -1:
@@ -1241,35 +1507,34 @@ class Board():
             whites_perspective = self.whites_move
         if whites_perspective:
             for i, row in enumerate(self.board[::-1]):
-                print(f"{8-i} {' '.join([Board.NUMBER_TO_PIECE.get(p,p) for p in row])}")
+                print(f"{8-i} {' '.join([Board.NUMBER_TO_PIECE[p] for p in row])}")
             print (f"  {' '.join(('A','B','C','D','E','F','G','H'))}")
         else:
             for i, row in enumerate (np.rot90(self.board, 2)[::-1]):
-                print(f"{i+1} {' '.join([Board.NUMBER_TO_PIECE.get(p,p) for p in row])}")
+                print(f"{i+1} {' '.join([Board.NUMBER_TO_PIECE[p] for p in row])}")
             print (f"  {' '.join(('A','B','C','D','E','F','G','H')[::-1])}")
 
     def piece_at(self,coord, letter_rep = True , flipped = False):
         
+        square = coord[0] + coord[1]*8
         if flipped:
-            b = np.rot90(self.board, 2)
-        else:
-            b = self.board
+            square = 63 - square
         if letter_rep:
-            return Board.NUMBER_TO_PIECE[b[coord[1]][coord[0]]]
-        return b[coord[1]][coord[0]]
+            return Board.NUMBER_TO_PIECE[self.squares[square]]
+        return self.squares[square]
     
 
 def test():
     b = Board("8/8/8/8/8/8/8/8 w KQkq - 0 1")
     for i in range(8):
         for j in range (8):
-            b.board[i][j] = 5
+            b.squares[i*8 + j] = 5
             b.init_bitboards()
             b.display_bitboard(b.bb_white_queens)
             print()
             b.display_bitboard(b.queen_moves(True))
             print("-"*10)
-            b.board[i][j] = 0
+            b.squares[i*8 + j] = 0
 
 if __name__ == "__main__":
 
@@ -0,0 +1,169 @@
+import numpy as np
+from board import Board, POSITION_STRUCT, KNIGHT_ATTACKS, KING_ATTACKS, PAWN_ATTACKS, RANK_LINES, FILE_LINES, DIAGONAL_LINES, ANTI_DIAGONAL_LINES
+
+# Bitboard columns of a batch, white pieces then black pieces
+PIECE_COLUMNS = ("bb_white_pawns", "bb_white_knights", "bb_white_bishops", "bb_white_rooks", "bb_white_queens", "bb_white_king",
+                 "bb_black_pawns", "bb_black_knights", "bb_black_bishops", "bb_black_rooks", "bb_black_queens", "bb_black_king")
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+PIECE_VALUES = np.array([1, 3, 3, 5, 9, 0], dtype=np.int64)
+# Nibble of each column in the packed position format (see Board.to_bytes), black pieces are piece & 0xF
+PIECE_NIBBLES = (1, 2, 3, 4, 5, 6, 15, 14, 13, 12, 11, 10)
+# FEN letter of each column, and the table expanding a FEN placement to one character per square (a8 first)
+FEN_PIECES = "PNBRQKpnbrqk"
+FEN_SQUARES_TABLE = str.maketrans({**{str(empty): "." * empty for empty in range(1, 9)}, "/": None})
+FEN_CASTLING = {"K": Board.WHITE_KING_CASTLE, "Q": Board.WHITE_QUEEN_CASTLE, "k": Board.BLACK_KING_CASTLE, "q": Board.BLACK_QUEEN_CASTLE}
+
+KNIGHT_TABLE = np.array(KNIGHT_ATTACKS, dtype=np.uint64)
+KING_TABLE = np.array(KING_ATTACKS, dtype=np.uint64)
+PAWN_TABLE = np.array(PAWN_ATTACKS, dtype=np.uint64)
+POPCOUNT_TABLE = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+def line_table_arrays(line_table):
+    return (np.array([inner_mask for inner_mask, _ in line_table], dtype=np.uint64),
+            np.array([attacks for _, attacks in line_table], dtype=np.uint64))
+
+RANK_ARRAYS = line_table_arrays(RANK_LINES)
+FILE_ARRAYS = line_table_arrays(FILE_LINES)
+DIAGONAL_ARRAYS = line_table_arrays(DIAGONAL_LINES)
+ANTI_DIAGONAL_ARRAYS = line_table_arrays(ANTI_DIAGONAL_LINES)
+B_FILE_MULTIPLIER = np.uint64(0x0202020202020202)
+C2_H7_MULTIPLIER = np.uint64(0x0004081020408000)
+INDEX_SHIFT = np.uint64(58)
+
+def line_attacks(line_arrays, squares, occupancy, multiplier, file_line=False):
+    # uint64 multiplication wraps at 64 bits, the same index as board.rook_attacks / bishop_attacks
+    inner_masks, attacks = line_arrays
+    line_occupancy = occupancy & inner_masks[squares]
+    if file_line:
+        line_occupancy >>= (squares & 7).astype(np.uint64)
+    return attacks[squares, ((line_occupancy * multiplier) >> INDEX_SHIFT).astype(np.intp)]
+
+def rook_attacks(squares, occupancy):
+    return line_attacks(RANK_ARRAYS, squares, occupancy, B_FILE_MULTIPLIER) | line_attacks(FILE_ARRAYS, squares, occupancy, C2_H7_MULTIPLIER, file_line=True)
+
+def bishop_attacks(squares, occupancy):
+    return line_attacks(DIAGONAL_ARRAYS, squares, occupancy, B_FILE_MULTIPLIER) | line_attacks(ANTI_DIAGONAL_ARRAYS, squares, occupancy, B_FILE_MULTIPLIER)
+
+def popcount(bitboards):
+    # np.bitwise_count needs numpy 2.0, older versions count bytes through a lookup table
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bitboards).astype(np.int64)
+    bytes_view = np.ascontiguousarray(bitboards, dtype=np.uint64).view(np.uint8)
+    return POPCOUNT_TABLE[bytes_view].reshape(*bitboards.shape, 8).sum(axis=-1, dtype=np.int64)
+
+def lowest_square(bitboards):
+    # Square of the lowest set bit, -1 for empty bitboards
+    lowest = bitboards & (~bitboards + np.uint64(1))
+    squares = np.log2(np.where(lowest == 0, 1, lowest).astype(np.float64)).astype(np.intp)
+    return np.where(lowest == 0, -1, squares)
+
+class BoardBatch:
+    def __init__(self, bitboards, whites_move, castling_rights, en_passant, nodes=None):
+        # bitboards is (N, 12) uint64 in PIECE_COLUMNS order, en_passant the square or -1
+        self.bitboards = bitboards
+        self.whites_move = whites_move
+        self.castling_rights = castling_rights
+        self.en_passant = en_passant
+        # Objects the positions came from (tree nodes), kept aligned through filtering
+        self.nodes = nodes
+
+    @classmethod
+    def from_boards(cls, boards, nodes=None):
+        boards = list(boards)
+        bitboards = np.array([[getattr(b, column) for column in PIECE_COLUMNS] for b in boards], dtype=np.uint64).reshape(len(boards), 12)
+        whites_move = np.array([bool(b.whites_move) for b in boards], dtype=bool)
+        castling_rights = np.array([b.castling_rights for b in boards], dtype=np.uint8)
+        en_passant = np.array([b.en_passant_square[0] + b.en_passant_square[1] * 8 if b.en_passant_square else -1 for b in boards], dtype=np.int8)
+        return cls(bitboards, whites_move, castling_rights, en_passant, nodes)
+
+    @classmethod
+    def from_fens(cls, fens, nodes=None):
+        # No Board per FEN, the placements are expanded to 64 characters each and packed into bitboards all at once
+        fields = [fen.split(" ") for fen in fens]
+        placements = "".join(field[0].translate(FEN_SQUARES_TABLE) for field in fields).encode()
+        squares = np.frombuffer(placements, dtype=np.uint8).reshape(-1, 8, 8)[:, ::-1].reshape(-1, 64)
+        bitboards = np.empty((len(squares), 12), dtype=np.uint64)
+        for column, piece in enumerate(FEN_PIECES):
+            bitboards[:, column] = np.packbits(squares == ord(piece), axis=1, bitorder="little").view("<u8")[:, 0]
+        whites_move = np.array([field[1][0] not in "bB" for field in fields], dtype=bool)
+        castling_rights = np.array([sum(FEN_CASTLING.get(right, 0) for right in field[2]) for field in fields], dtype=np.uint8)
+        en_passant = np.array([-1 if field[3][0] == "-" else ord(field[3][0]) - ord("a") + (int(field[3][1]) - 1) * 8 for field in fields], dtype=np.int8)
+        return cls(bitboards, whites_move, castling_rights, en_passant, nodes)
+
+    @classmethod
+    def from_bytes(cls, positions, nodes=None):
+        # positions is an iterable of Board.to_bytes() records or those records joined into one bytes object
+        if not isinstance(positions, (bytes, bytearray)):
+            positions = b"".join(positions)
+        data = np.frombuffer(positions, dtype=np.uint8).reshape(-1, POSITION_STRUCT.size)
+        nibbles = np.empty((len(data), 64), dtype=np.uint8)
+        nibbles[:, 0::2] = data[:, :32] & 0xF
+        nibbles[:, 1::2] = data[:, :32] >> 4
+        bitboards = np.empty((len(data), 12), dtype=np.uint64)
+        for column, nibble in enumerate(PIECE_NIBBLES):
+            bitboards[:, column] = np.packbits(nibbles == nibble, axis=1, bitorder="little").view("<u8")[:, 0]
+        en_passant = data[:, 33].astype(np.int8)
+        en_passant[data[:, 33] == 255] = -1
+        return cls(bitboards, (data[:, 32] & 1).astype(bool), data[:, 32] >> 1, en_passant, nodes)
+
+    @classmethod
+    def from_tree(cls, tree):
+        # Every position of an OpeningTree or StudyTree, batch.nodes holds the matching tree nodes
+        nodes = list(tree.nodes.values())
+        node_array = np.empty(len(nodes), dtype=object)
+        node_array[:] = nodes
+        return cls.from_fens((node.fen for node in nodes), node_array)
+
+    def __len__(self):
+        return len(self.bitboards)
+
+    def __getitem__(self, index):
+        # Numpy indexing over positions, e.g. batch[batch.in_check()]
+        if isinstance(index, (int, np.integer)):
+            index = [index]
+        return BoardBatch(self.bitboards[index], self.whites_move[index], self.castling_rights[index], self.en_passant[index],
+                          None if self.nodes is None else self.nodes[index])
+
+    def white_occupancy(self):
+        return np.bitwise_or.reduce(self.bitboards[:, :6], axis=1)
+
+    def black_occupancy(self):
+        return np.bitwise_or.reduce(self.bitboards[:, 6:], axis=1)
+
+    def occupancy(self):
+        return np.bitwise_or.reduce(self.bitboards, axis=1)
+
+    def piece_counts(self):
+        # (N, 12) number of each piece in PIECE_COLUMNS order
+        return popcount(self.bitboards)
+
+    def material(self):
+        # (N, 2) white and black material with pawn = 1, knight = bishop = 3, rook = 5, queen = 9
+        counts = self.piece_counts()
+        return np.stack((counts[:, :6] @ PIECE_VALUES, counts[:, 6:] @ PIECE_VALUES), axis=1)
+
+    def material_balance(self):
+        material = self.material()
+        return material[:, 0] - material[:, 1]
+
+    def piece_square_counts(self):
+        # (12, 64) number of positions with each piece on each square
+        bits = np.unpackbits(np.ascontiguousarray(self.bitboards).view(np.uint8), bitorder="little")
+        return bits.reshape(len(self), 12, 64).sum(axis=0, dtype=np.int64)
+
+    def in_check(self):
+        # True where the side to move is in check
+        white = self.whites_move
+        bitboards = self.bitboards
+        own = np.where(white[:, None], bitboards[:, :6], bitboards[:, 6:])
+        enemy = np.where(white[:, None], bitboards[:, 6:], bitboards[:, :6])
+        king_squares = lowest_square(own[:, KING])
+        has_king = king_squares >= 0
+        king_squares = np.where(has_king, king_squares, 0)
+        occupancy = self.occupancy()
+        attackers = ((PAWN_TABLE[white.astype(np.intp), king_squares] & enemy[:, PAWN])
+                     | (KNIGHT_TABLE[king_squares] & enemy[:, KNIGHT])
+                     | (KING_TABLE[king_squares] & enemy[:, KING])
+                     | (rook_attacks(king_squares, occupancy) & (enemy[:, ROOK] | enemy[:, QUEEN]))
+                     | (bishop_attacks(king_squares, occupancy) & (enemy[:, BISHOP] | enemy[:, QUEEN])))
+        return has_king & (attackers != 0)
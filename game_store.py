@@ -0,0 +1,150 @@
+import os
+import json
+from array import array
+
+MANIFEST_FILE = "manifest.json"
+PLAYER_COLORS = ("white", "black", "other")
+
+def json_default(obj):
+    # move codes are array('H') in memory and lists of ints in the json files
+    if isinstance(obj, array):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def restore_move_codes(games):
+    for g in games:
+        if "move_codes" in g:
+            g["move_codes"] = array('H', g["move_codes"])
+    return games
+
+def player_color(g):
+    return g.get("player_color", "") or "other"
+
+def player_key(g):
+    # "platform/username" of the player whose games these are, None for games without a platform
+    platform = g.get("platform")
+    player = g.get(g.get("player_color", ""))
+    if not platform or not isinstance(player, dict):
+        return None
+    return f"{platform}/{player.get('username', '').lower()}"
+
+def write_json_atomic(path, obj):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(temp_path, path)
+
+class GameStore:
+    # The games of one import as a directory of append-only NDJSON segments, one game per line.
+    # manifest.json lists the segments with their game count per player color and the latest
+    # end_time of every platform/player, so appending never reads or rewrites the games already stored
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, MANIFEST_FILE)
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"segments": []}
+
+    @property
+    def segments(self):
+        return self.manifest["segments"]
+
+    def __len__(self):
+        return sum(segment["games"] for segment in self.segments)
+
+    def segment_paths(self):
+        return [os.path.join(self.path, segment["file"]) for segment in self.segments]
+
+    def write_segment(self, games):
+        # Writes games (any iterable, it is consumed one game at a time) to a new segment file and returns its manifest
+        # entry, None when there were no games. The manifest itself is left to the caller
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        number = max((int(segment["file"][8:-7]) for segment in self.segments), default=0) + 1
+        segment = {"file": f"segment_{number:06d}.ndjson", "games": 0, "colors": dict.fromkeys(PLAYER_COLORS, 0), "end_times": {}}
+        segment_path = os.path.join(self.path, segment["file"])
+        try:
+            with open(f"{segment_path}.tmp", "w") as f:
+                for g in games:
+                    f.write(json.dumps(g, default=json_default))
+                    f.write("\n")
+                    segment["games"] += 1
+                    segment["colors"][player_color(g)] += 1
+                    key = player_key(g)
+                    if key and g.get("end_time"):
+                        segment["end_times"][key] = max(segment["end_times"].get(key, 0), g["end_time"])
+        except BaseException:
+            # games can be a download stream that fails partway, the unfinished segment isn't kept
+            if os.path.isfile(f"{segment_path}.tmp"):
+                os.remove(f"{segment_path}.tmp")
+            raise
+        if not segment["games"]:
+            os.remove(f"{segment_path}.tmp")
+            return None
+        os.replace(f"{segment_path}.tmp", segment_path)
+        return segment
+
+    def append(self, games):
+        # Writes games as a new segment, returns its manifest entry (None when there is nothing to write)
+        segment = self.write_segment(games)
+        if segment is None:
+            return None
+        self.segments.append(segment)
+        write_json_atomic(self.manifest_path, self.manifest)
+        return segment
+
+    def replace(self, games):
+        # Makes games the only segment of the store. The old segments are deleted after the new manifest is written,
+        # so a failed import leaves the games that were stored before it. When games is empty (a download that failed
+        # or found nothing) the store is left as it is and None is returned
+        old_paths = self.segment_paths()
+        segment = self.write_segment(games)
+        if segment is None:
+            return None
+        self.manifest = {"segments": [segment] if segment else []}
+        write_json_atomic(self.manifest_path, self.manifest)
+        for segment_path in old_paths:
+            if os.path.isfile(segment_path):
+                os.remove(segment_path)
+        return segment
+
+    def iter_games(self, color=None, segments=None):
+        # Streams the stored games, only of one player color ("white", "black" or "other") if given
+        for segment in self.segments if segments is None else segments:
+            if color and not segment["colors"].get(color):
+                continue
+            with open(os.path.join(self.path, segment["file"]), "r") as f:
+                for line in f:
+                    g = json.loads(line)
+                    if color and player_color(g) != color:
+                        continue
+                    yield restore_move_codes([g])[0]
+
+    def load(self, color=None):
+        return list(self.iter_games(color))
+
+    def load_by_color(self):
+        # {"white": [...], "black": [...], "other": [...]} in one pass over the segments
+        games = {color: [] for color in PLAYER_COLORS}
+        for g in self.iter_games():
+            games[player_color(g)].append(g)
+        return games
+
+    def latest_end_time(self, platform, username):
+        key = f"{platform}/{username.lower()}"
+        return max((segment["end_times"][key] for segment in self.segments if key in segment["end_times"]), default=None)
+
+    def segments_since(self, platform, username, end_time):
+        # Segments holding games of username on platform that ended at or after end_time
+        key = f"{platform}/{username.lower()}"
+        return [segment for segment in self.segments if segment["end_times"].get(key, -1) >= end_time]
+
+    def clear(self):
+        for segment_path in self.segment_paths():
+            if os.path.isfile(segment_path):
+                os.remove(segment_path)
+        self.manifest = {"segments": []}
+        if os.path.isfile(self.manifest_path):
+            os.remove(self.manifest_path)
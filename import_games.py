@@ -1,13 +1,21 @@
+import io
 import os
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import time
 import glob
 import json
-import ndjson
 import shutil
 import requests
 import re
+import hashlib
+import threading
+from array import array
+from collections import deque
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from board import Board
+from game_store import GameStore, MANIFEST_FILE, json_default, restore_move_codes
 
 ANNOTATION_NAGS = {
     0: "null annotation",
@@ -152,9 +160,76 @@ ANNOTATION_NAGS = {
     139: "Black has severe time control pressure"
 }
 
-def load_json_from_api(url, header=None, params = None, fmt = None):
-    response = requests.get(url, headers=header, params=params)
-    print(url)
+# Token kinds of iter_pgn_tokens
+SAN, RESULT, NAG, COMMENT, VARIATION_START, VARIATION_END = "san", "result", "nag", "comment", "variation_start", "variation_end"
+# Group names are the token kinds, whitespace, move numbers and tags are skipped before every token
+# Every position of the skipped prefix can only be consumed one way and every token ends in a catch-all, so a
+# match never fails and never backtracks into the prefix (whitespace runs, stray braces and detached suffixes stay linear)
+PGN_TOKEN_REGEX = re.compile(r"""
+    (?:\s|\d+\.+|\[[^\]\n]*\])*
+    (?:
+        (?P<san>[^\s(){};$\[\]!?]+)(?P<suffix>[!?]+)?
+      | \{(?P<comment>[^}]*)\}
+      | \$(?P<nag>\d+)
+      | (?P<variation_start>\()
+      | (?P<variation_end>\))
+      | ;(?P<line_comment>[^\n]*)
+      | (?P<other>\S|\Z)
+    )
+""", re.VERBOSE)
+RESULTS = {"1-0", "0-1", "1/2-1/2", "*"}
+# Move suffixes written as NAGs
+SUFFIX_NAGS = {"!": 1, "?": 2, "!!": 3, "??": 4, "!?": 5, "?!": 6}
+
+CHESS_COM_API_URL = "https://api.chess.com/pub"
+# chess.com answers 429 when too many archive requests run at once
+DOWNLOAD_WORKERS = 3
+# Seconds to wait for the server to answer (or send the next chunk of a stream)
+REQUEST_TIMEOUT = 30
+# Rate limited (429) and server error responses are retried this many times with exponential backoff
+REQUEST_RETRIES = 4
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+ARCHIVE_CACHE_DIR = "archive_cache"
+LICHESS_API_URL = "https://lichess.org/api"
+# Pgn files bigger than this are split on [Event boundaries and parsed by several workers
+PGN_CHUNK_SIZE = 16 * 1024 * 1024
+# Games sent to a worker at a time by iter_prepared_games
+GAME_CHUNK_SIZE = 250
+# lichess filters the export on when games started, look back far enough to catch games that were still running
+LICHESS_SYNC_OVERLAP = 6 * 60 * 60
+
+def retry_delay(response, attempt):
+    # Seconds to wait before the next attempt, the server's Retry-After (seconds or an http date) when it sent one
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return 2 ** attempt
+
+def get_with_retry(url, session=None, retries=REQUEST_RETRIES, timeout=REQUEST_TIMEOUT, **kwargs):
+    # requests GET with a timeout that retries rate limits, server errors, timeouts and dropped connections.
+    # The last response is returned once retries run out, the last exception raised
+    for attempt in range(retries + 1):
+        try:
+            response = (session or requests).get(url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            time.sleep(retry_delay(None, attempt))
+            continue
+        if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+            return response
+        delay = retry_delay(response, attempt)
+        response.close()
+        time.sleep(delay)
+
+def load_json_from_api(url, header=None, params = None, fmt = None, session = None):
+    response = get_with_retry(url, session=session, headers=header, params=params)
     if response.status_code == 200:
         
         #return response
@@ -164,9 +239,116 @@ def load_json_from_api(url, header=None, params = None, fmt = None):
             json_data = response.json(cls=fmt)
         return json_data
     else:
-        print(f"Error: Failed to retrieve data from the API. Status Code {response.status_code}")
+        print(f"Error: Failed to retrieve data from the API ({url}). Status Code {response.status_code}")
         return None
 
+def archive_month_complete(url):
+    # A monthly archive can't change anymore once its month ended, give late games a day to show up
+    year, month = url.split('/')[-2:]
+    last_day = datetime.now(timezone.utc) - timedelta(days=1)
+    return (int(year), int(month)) < (last_day.year, last_day.month)
+
+def load_cached_json(url, cache_dir, header=None, complete=False, session=None):
+    # Responses are cached in cache_dir by url. Complete entries are served from disk,
+    # the rest are revalidated with their ETag / Last-Modified and only downloaded again when changed
+    cache_path = os.path.join(cache_dir, f"{hashlib.sha1(url.encode()).hexdigest()}.json")
+    cached = None
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "r") as f:
+                cached = json.load(f)
+            cached_json = json.loads(cached["text"])
+        except (ValueError, KeyError, TypeError):
+            # A truncated or corrupt entry is dropped and downloaded again
+            print(f"Cached copy of {url} is corrupt, downloading it again")
+            os.remove(cache_path)
+            cached = None
+        if cached and cached.get("complete"):
+            return cached_json
+
+    headers = dict(header or {})
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        response = get_with_retry(url, session=session, headers=headers)
+    except requests.RequestException as e:
+        if not cached:
+            raise
+        print(f"Error: Failed to retrieve data from the API ({url}), using the cached copy. {e}")
+        return cached_json
+    if response.status_code == 304 and cached:
+        text = cached["text"]
+        data = cached_json
+    elif response.status_code == 200:
+        text = response.text
+        # Raises ValueError on a body that isn't json, before it gets into the cache
+        data = json.loads(text)
+    else:
+        print(f"Error: Failed to retrieve data from the API ({url}). Status Code {response.status_code}")
+        return cached_json if cached else None
+
+    entry = {
+        "url": url,
+        "etag": response.headers.get("ETag", cached and cached.get("etag")),
+        "last_modified": response.headers.get("Last-Modified", cached and cached.get("last_modified")),
+        "complete": complete,
+        "text": text,
+    }
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(entry, f)
+    os.replace(temp_path, cache_path)
+    return data
+
+def download_chess_com_archives(urls, header=None, workers=DOWNLOAD_WORKERS, mesg_label=None, cache_dir=None):
+    # Fetches the monthly archives on a thread pool, returns the games of every month in the order of urls.
+    # A month that fails is reported and skipped, the other months are still returned
+    month_games = [None] * len(urls)
+    failed = []
+    # One keep-alive session per download thread, requests.Session is not safe to share between threads.
+    # They are closed once the pool is done
+    thread_sessions = threading.local()
+    sessions = []
+
+    def get_session():
+        session = getattr(thread_sessions, "session", None)
+        if session is None:
+            session = thread_sessions.session = requests.Session()
+            sessions.append(session)
+        return session
+
+    def download(url):
+        if cache_dir:
+            return load_cached_json(url, cache_dir, header, complete=archive_month_complete(url), session=get_session())
+        return load_json_from_api(url, header, session=get_session())
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(download, url): i for i, url in enumerate(urls)}
+            for done, future in enumerate(as_completed(futures), start=1):
+                i = futures[future]
+                month_name = '/'.join(urls[i].split('/')[-2:])
+                try:
+                    month = future.result()
+                except (requests.RequestException, ValueError) as e:
+                    # ValueError is a response body that isn't json
+                    print(f"Error: Failed to retrieve data from the API ({urls[i]}). {e}")
+                    month = None
+                if month is None:
+                    failed.append(month_name)
+                month_games[i] = month.get("games", []) if month else []
+                prints(f"Downloaded {month_name} ({len(month_games[i])} games), {done}/{len(urls)} months", mesg_label)
+    finally:
+        for session in sessions:
+            session.close()
+    if failed:
+        prints(f"Failed to download {len(failed)} months: {', '.join(sorted(failed))}", mesg_label)
+    return [g for games in month_games for g in games]
+
 def date_to_epoch(date_string):
     if date_string:
         date_object = datetime.strptime(date_string, "%Y-%m-%d")
@@ -174,7 +356,7 @@ def date_to_epoch(date_string):
         return epoch_time
     return None
 
-def get_chess_com_games(username=None, time_formats=None, rated=True, from_date=None, to_date=None, save = False, mesg_label= None):
+def get_chess_com_games(username=None, time_formats=None, rated=True, from_date=None, to_date=None, save = False, mesg_label= None, workers=None, api_url=None, cache_dir=None):
     
     with open(f".\\config.json", "r") as f:
         config = json.load(f)
@@ -190,25 +372,39 @@ def get_chess_com_games(username=None, time_formats=None, rated=True, from_date=
         to_year, to_month, _ = [int(d) for d in to_date.split('-')]
         to_epoch = date_to_epoch(to_date)
 
+    if workers == None:
+        workers = config.get("download_workers", DOWNLOAD_WORKERS)
+    if api_url == None:
+        api_url = config.get("chess_com_api_url", CHESS_COM_API_URL)
+    if cache_dir == None:
+        cache_dir = config.get("archive_cache_dir", ARCHIVE_CACHE_DIR)
+
     imported_dir = config.get("imported_dir")
     header = {'User-Agent': config.get("email")}
-    api_url = f"https://api.chess.com/pub/player/{username}/games/archives"
-    monthlyURLS = load_json_from_api(api_url, header)
+    archives_url = f"{api_url}/player/{username}/games/archives"
+    try:
+        if cache_dir:
+            monthlyURLS = load_cached_json(archives_url, cache_dir, header)
+        else:
+            monthlyURLS = load_json_from_api(archives_url, header)
+    except (requests.RequestException, ValueError) as e:
+        print(f"Error: Failed to retrieve data from the API ({archives_url}). {e}")
+        return None
     if monthlyURLS is None:
         return None
     
     monthlyURLS = monthlyURLS.get("archives")
     
-    games = []
+    urls = []
 
     for url in monthlyURLS:
         year, month = url.split('/')[-2:]
 
         if (not from_date or (int(year) > from_year or (int(year) == from_year and int(month) >= from_month))) and \
            (not to_date or (int(year) < to_year or (int(year) == to_year and int(month) <= to_month))):
-            monthGames = load_json_from_api(url, header)
-            games.extend(monthGames.get("games"))
-            prints(f"{len(games)} ingested so far, Up to date {'/'.join(url.split('/')[-2:])}", mesg_label)
+            urls.append(url)
+    games = download_chess_com_archives(urls, header, workers, mesg_label, cache_dir)
+    prints(f"{len(games)} ingested from {len(urls)} months", mesg_label)
     if rated:
         games = list(filter(lambda g: g.get("rated") == True and g.get("time_class") in time_formats and g.get("rules") == "chess" and g.get("initial_setup") == "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", games))
     else:
@@ -235,16 +431,26 @@ def load_games (file_name, filtered_games = None):
 
     imported_dir = config.get("imported_dir")
 
+    # file_name is a game store directory (see import_all_games) or a json file written by dump_games.
+    # Stores are named without ".json", "name.json" finds the store of name before the legacy file
+    store_path = os.path.join(imported_dir, file_name[:-5] if file_name.endswith(".json") else file_name)
+    if os.path.isfile(os.path.join(store_path, MANIFEST_FILE)):
+        store = GameStore(store_path)
+        if filtered_games:
+            return store.load(filtered_games.split("_")[0])
+        games = store.load_by_color()
+        return games["white"] + games["black"] + games["other"]
+
     if file_name.endswith(".json"):
         full_file_path = f"{imported_dir}\\{file_name}"
         with open(full_file_path, "r") as f:
             games_dict = json.load(f)
         if filtered_games:
-            return games_dict.get(filtered_games,[])
+            return restore_move_codes(games_dict.get(filtered_games,[]))
         games = games_dict.get("white_games",[])
         games.extend(games_dict.get("black_games",[]))
         games.extend(games_dict.get("other_games",[]))
-        return games
+        return restore_move_codes(games)
 
 def load_study (file_name):
     with open(".\\config.json", "r") as f:
@@ -266,29 +472,155 @@ def sanitize_png_moves(games, mesg_label=None, sub_mesg_label=None):
     for i,g in enumerate(games):
         if i %500 == 0:
             prints(f"Santized {i}/{len(games)} games", sub_mesg_label)
-        pgn = g["pgn"]
-        tags_and_move_numbers = re.compile(r"\[[^\]]+\]|\{[^\}]*\}|\d+\.+")
-        clean_png = re.sub(tags_and_move_numbers, '', pgn).strip()
-        moves = [i for i in clean_png.split(" ") if i]
-        if moves and moves[-1] == "1/2-1/2" or moves[-1] == "1-0" or moves[-1] == "0-1" or moves[-1] == '*':
-            g["result"] = moves.pop(-1)
-        g["clean_moves"] = moves
-    
+        sanitize_game(g)
+
+def iter_pgn_tokens(text):
+    # Yields (kind, value) tokens of pgn move text in one pass: SAN moves, results, NAGs (ints, move suffixes like !?
+    # included), comments (without braces) and variation starts and ends. Tags and move numbers are skipped
+    for match in PGN_TOKEN_REGEX.finditer(text):
+        kind = match.lastgroup
+        if kind == SAN:
+            san = match.group(SAN)
+            yield (RESULT if san in RESULTS else SAN), san
+        elif kind == COMMENT or kind == "line_comment":
+            yield COMMENT, match.group(kind).strip()
+        elif kind == NAG:
+            yield NAG, int(match.group(NAG))
+        elif kind == "suffix":
+            yield SAN, match.group(SAN)
+            if match.group("suffix") in SUFFIX_NAGS:
+                yield NAG, SUFFIX_NAGS[match.group("suffix")]
+        elif kind == VARIATION_START or kind == VARIATION_END:
+            yield kind, match.group(kind)
+
+def sanitize_game(g):
+    # Main line moves and result of the game, its comments ([%clk], [%eval], ...) are kept as [ply, comment] pairs
+    moves = []
+    comments = []
+    depth = 0
+    for kind, value in iter_pgn_tokens(g["pgn"]):
+        if kind == VARIATION_START:
+            depth += 1
+        elif kind == VARIATION_END:
+            # an unbalanced ) doesn't end the main line
+            depth = max(depth - 1, 0)
+        elif depth:
+            continue
+        elif kind == SAN:
+            moves.append(value)
+        elif kind == RESULT:
+            g["result"] = value
+        elif kind == COMMENT and value:
+            comments.append([len(moves), value])
+    g["clean_moves"] = moves
+    if comments:
+        g["comments"] = comments
+    return g
 
 def add_fen_list(games, mesg_label=None, sub_mesg_label=None):
-    prints("Adding FENs to each position in every game (Used for building trees and analysis later)",mesg_label)
+    prints("Replaying the moves of every game into move codes (Used for building trees and analysis later)",mesg_label)
     num_games = len(games)
     for i,g in enumerate(games):
         if i%500 == 0:
-            prints(f"Adding FENs for {i}/{num_games}",sub_mesg_label)
-        b = Board()
-        moves = g.get("clean_moves",None)
-        
-        if moves:
-            g["move_fen_list"] = [(move, b.make_algebraic_move(move)) for move in moves]
+            prints(f"Replaying {i}/{num_games}",sub_mesg_label)
+        add_fens(g, f"game {i}", sub_mesg_label)
+
+def add_fens(g, name=None, mesg_label=None):
+    moves = g.get("clean_moves",None)
+    
+    if moves:
+        codes, failure = Board.replay(moves, fmt="code")
+        # 16 bit move codes (see Board.encode_move) replace the SAN moves, Board.decode_moves turns them back into
+        # SAN or UCI and the trees replay them for FENs and keys
+        g["move_codes"] = array('H', codes)
+        if failure:
+            # The codes only reach the move that couldn't be played, the SAN of the whole game is kept
+            prints(f"Could not play {failure[1]} ({failure[2]}) at ply {failure[0]} in {g.get('url', name)}",mesg_label)
+            return g
+        g.pop("clean_moves", None)
+        g.pop("move_fen_list", None)
+        g.pop("move_key_list", None)
+    return g
+
+def prepare_pgn_chunk(pgns):
+    # Worker side of iter_prepared_games, gets (pgn, name) pairs and returns the fields it adds to each game
+    prepared = []
+    for pgn, name in pgns:
+        g = add_fens(sanitize_game({"pgn": pgn}), name)
+        prepared.append({key: value for key, value in g.items() if key != "pgn"})
+    return prepared
+
+def iter_prepared_games(games, workers=None, chunk_size=GAME_CHUNK_SIZE, mesg_label=None):
+    # Sanitizes and replays any iterable of games, yields them in order. With several workers
+    # chunks go to a process pool, at most two per worker are in flight so only those games are held in memory.
+    # Games that fit in one chunk are prepared here, a pool costs more to start than it saves on them
+    if workers == None:
+        workers = os.cpu_count() or 1
+    games = iter(games)
+    chunk = list(islice(games, chunk_size))
+    if workers <= 1 or len(chunk) < chunk_size:
+        yield from iter_games_with_fens(iter_sanitized_games(chain(chunk, games)), mesg_label)
+        return
+    prepared_games = 0
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            if chunk:
+                start = prepared_games + sum(len(queued) for queued, _ in pending)
+                pgns = [(g["pgn"], g.get("url", f"game {i}")) for i, g in enumerate(chunk, start)]
+                pending.append((chunk, executor.submit(prepare_pgn_chunk, pgns)))
+            if not pending:
+                return
+            if not chunk or len(pending) >= 2 * workers:
+                done_chunk, future = pending.popleft()
+                for g, prepared in zip(done_chunk, future.result()):
+                    g.update(prepared)
+                    yield g
+                prepared_games += len(done_chunk)
+                prints(f"Prepared {prepared_games} games", mesg_label)
+            chunk = list(islice(games, chunk_size))
+
+def iter_sanitized_games(games):
+    for g in games:
+        yield sanitize_game(g)
+
+def iter_games_with_fens(games, mesg_label=None):
+    for i, g in enumerate(games):
+        yield add_fens(g, f"game {i}", mesg_label)
+
        
 
-def get_lichess_games(username=None, time_formats=None, rated = True, from_epoch = None, to_epoch=None, save=False, mesg_label=None, sub_mesg_label=None):
+def normalize_lichess_game(g, lower_username):
+    g["end_time"] = g.get("lastMoveAt")//1000
+    g["time_class"] = g.get("speed")
+    g["winner"] = g.get("winner", "draw")
+    players = g.pop("players", None)
+    
+    g["white"] = players.get("white")
+    g["white"]["username"] = g.get("white").pop("user", {}).get("id","GUEST")
+    g["black"] = players.get("black")
+    g["black"]["username"] = g.get("black").pop("user", {}).get("id","GUEST")
+    g["platform"] = "lichess"
+    g["player_color"] = "white" if g.get("white").get("username").lower() == lower_username else "black"
+    return g
+
+def iter_lichess_games(api_url, username, header=None, params=None, session=None):
+    # Yields the games of the export one at a time as their lines arrive
+    response = get_with_retry(api_url, session=session, headers=header, params=params, stream=True)
+    if response.status_code != 200:
+        print(f"Error: Failed to retrieve data from the API ({api_url}). Status Code {response.status_code}")
+        response.close()
+        return
+    lower_username = username.lower()
+    with response:
+        for line in response.iter_lines():
+            if line:
+                yield normalize_lichess_game(json.loads(line), lower_username)
+
+def iter_user_lichess_games(username=None, time_formats=None, rated = True, from_epoch = None, to_epoch=None, mesg_label=None, sub_mesg_label=None, process=False, api_url=None, known_ids=None):
+    # Yields the lichess games of username as the export streams in.
+    # from_epoch and to_epoch are epoch seconds, games whose id is in known_ids are skipped.
+    # With process the games are sanitized and get their FENs while the rest of the export is still downloading
         
     with open(f".\\config.json", "r") as f:
         config = json.load(f)
@@ -296,7 +628,6 @@ def get_lichess_games(username=None, time_formats=None, rated = True, from_epoch
         username = config.get("lichess_user")
     if time_formats == None:
         time_formats = config.get("time_formats")
-    imported_dir = config.get("imported_dir")
     if config.get("lichess_token",""):
         header = {"Authorization": f"Bearer {config.get('lichess_token')}",
              "Accept": "application/x-ndjson"}
@@ -305,68 +636,69 @@ def get_lichess_games(username=None, time_formats=None, rated = True, from_epoch
 
     if username==None:
         username = config.get('user')
-
-    api_url = f"https://lichess.org/api/games/user/{username}"
+    if api_url == None:
+        api_url = config.get("lichess_api_url", LICHESS_API_URL)
     
     params = {
         "pgnInJson": True,
         "lastFen":True,
         "perfType":",".join(time_formats)
     }
+    # lichess takes milliseconds
     if from_epoch:
-        params["since"] = from_epoch
+        params["since"] = from_epoch * 1000
     if to_epoch:
-        params["until"] = to_epoch
+        params["until"] = to_epoch * 1000
     if rated:
         params["rated"] = rated
      
     prints("This may take a few minutes...\nApproximately 60 games/sec if you inputted a token or 20 games/ sec otherwise", mesg_label)
-    games = load_json_from_api(api_url,header=header, params = params, fmt = ndjson.Decoder)
-    
-    lower_username=username.lower()
-    for g in games:
-        g["end_time"] = g.get("lastMoveAt")//1000
-        g["time_class"] = g.get("speed")
-        g["winner"] = g.get("winner", "draw")
-        players = g.pop("players", None)
-        
-        g["white"] = players.get("white")
-        g["white"]["username"] = g.get("white").pop("user", {}).get("id","GUEST")
-        g["black"] = players.get("black")
-        g["black"]["username"] = g.get("black").pop("user", {}).get("id","GUEST")
-        g["platform"] = "lichess"
-        g["player_color"] = "white" if g.get("white").get("username").lower() == lower_username else "black"
-        
+    stream = iter_lichess_games(f"{api_url}/games/user/{username}", username, header=header, params=params)
+    if known_ids:
+        stream = (g for g in stream if g.get("id") not in known_ids)
+    if process:
+        stream = iter_games_with_fens(iter_sanitized_games(stream), sub_mesg_label)
+    downloaded = 0
+    for g in stream:
+        yield g
+        downloaded += 1
+        if downloaded % 500 == 0:
+            prints(f"{downloaded} lichess games downloaded so far", sub_mesg_label)
+    prints(f"Downloaded {downloaded} lichess games", sub_mesg_label)
+
+def get_lichess_games(username=None, time_formats=None, rated = True, from_epoch = None, to_epoch=None, save=False, mesg_label=None, sub_mesg_label=None, process=False, api_url=None, known_ids=None):
+    # List of iter_user_lichess_games, with save it is also written to the imported_dir
+    games = list(iter_user_lichess_games(username, time_formats, rated, from_epoch, to_epoch, mesg_label, sub_mesg_label, process, api_url, known_ids))
     
     if save: 
+        with open(".\\config.json", "r") as f:
+            config = json.load(f)
+        if username==None:
+            username = config.get("lichess_user") or config.get('user')
+        imported_dir = config.get("imported_dir")
         with open(f".\\{imported_dir}\\lc_{username}_all_games.json", "w") as f:
-            json.dump(games,f)
+            json.dump(games,f,default=json_default)
    
     return games
 
 
-def import_pgn_file(file_path, username=None, save = False):
-    
-    with open(f".\\config.json", "r") as f:
-        config = json.load(f)
-    if username==None:
-        username = config.get('name')
-    imported_dir = config.get("imported_dir")
-    file_path = os.path.normpath(file_path)
-    with open(f"{file_path}{'.pgn' if not file_path.endswith('.pgn') else''}", "r") as f:
-        lines = f.readlines()
-    games = []
+def iter_pgn_games(file_path, username=None):
+    # Yields the games of a pgn file one at a time, only the lines of the current game are kept in memory
+    with open(file_path, "r") as f:
+        yield from iter_pgn_lines(f, username)
+
+def iter_pgn_lines(lines, username=None):
     g = None
-    pgn=""
     for line in lines:
-        pgn+=f"{line}\n"
         if line.startswith("[Event"):
-            if g!= None:
-                g["pgn"]=pgn
-                g["moves"] = g.get('moves','').strip()
-                games.append(g)
-                pgn=""
-            g=dict()
+            if g != None:
+                yield finish_pgn_game(g, pgn_lines, move_lines)
+            g = dict()
+            pgn_lines = []
+            move_lines = []
+        if g == None:
+            continue
+        pgn_lines.append(f"{line}\n")
         if line[0] == "[":
             tag = line[1:].split('"')
             tag[0]=tag[0].lower()
@@ -374,11 +706,77 @@ def import_pgn_file(file_path, username=None, save = False):
             if (tag[0] == "white" or tag[0] == "black") and tag[1] == username:
                 g["player_color"] = tag[0]
         else:
-            g["moves"]=f"{g.get('moves','')}{line}\n"
-    if g!= None:
-        g["pgn"]=pgn
-        g["moves"] = g.get('moves','').strip()
-        games.append(g)
+            move_lines.append(f"{line}\n")
+    if g != None:
+        yield finish_pgn_game(g, pgn_lines, move_lines)
+
+def finish_pgn_game(g, pgn_lines, move_lines):
+    g["pgn"] = "".join(pgn_lines)
+    g["moves"] = "".join(move_lines).strip()
+    return g
+
+def pgn_chunks(file_path, chunk_size=PGN_CHUNK_SIZE):
+    # (start, end) byte ranges of about chunk_size that each begin on an [Event line
+    size = os.path.getsize(file_path)
+    starts = [0]
+    with open(file_path, "rb") as f:
+        while starts[-1] + chunk_size < size:
+            f.seek(starts[-1] + chunk_size)
+            f.readline()
+            while True:
+                start = f.tell()
+                line = f.readline()
+                if not line or line.startswith(b"[Event"):
+                    break
+            if not line:
+                break
+            starts.append(start)
+    return list(zip(starts, starts[1:] + [size]))
+
+def parse_pgn_chunk(file_path, start, end, username=None):
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # Same decoding and newline handling as opening the file in text mode
+    return list(iter_pgn_lines(io.TextIOWrapper(io.BytesIO(data)), username))
+
+def iter_pgn_file_chunks(pgn_files, username=None, workers=None):
+    # (file index, games) for the files in order. With several workers the files and the chunks of big files are parsed
+    # by a process pool, at most two chunks per worker are in flight. Otherwise each file is one iterator of its games
+    if workers == None:
+        workers = os.cpu_count() or 1
+    tasks = [(i, pgn_file, start, end) for i, pgn_file in enumerate(pgn_files) for start, end in pgn_chunks(pgn_file)]
+    if workers <= 1 or len(tasks) <= 1:
+        for i, pgn_file in enumerate(pgn_files):
+            yield i, iter_pgn_games(pgn_file, username)
+        return
+    tasks = iter(tasks)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for i, pgn_file, start, end in islice(tasks, 2 * workers - len(pending)):
+                pending.append((i, executor.submit(parse_pgn_chunk, pgn_file, start, end, username)))
+            if not pending:
+                return
+            i, future = pending.popleft()
+            yield i, future.result()
+
+def parse_pgn_files(pgn_files, username=None, workers=None):
+    # Games of every file in order, one list per file
+    file_games = [[] for _ in pgn_files]
+    for i, games in iter_pgn_file_chunks(pgn_files, username, workers):
+        file_games[i].extend(games)
+    return file_games
+
+def import_pgn_file(file_path, username=None, save = False):
+    
+    with open(f".\\config.json", "r") as f:
+        config = json.load(f)
+    if username==None:
+        username = config.get('name')
+    imported_dir = config.get("imported_dir")
+    file_path = os.path.normpath(file_path)
+    games = list(iter_pgn_games(f"{file_path}{'.pgn' if not file_path.endswith('.pgn') else''}", username))
         
     file_name = file_path.split("\\")[-1]
     if save:
@@ -388,11 +786,14 @@ def import_pgn_file(file_path, username=None, save = False):
     return games
 
 
-def ingest_pgns(pgn_files=None, username=None, mesg_label=None, move_file = True, seperate = False, study=False):
+def ingest_pgns(pgn_files=None, username=None, mesg_label=None, move_file = True, seperate = False, study=False, workers=None):
+    # workers is the number of processes parsing the files, defaults to "ingest_workers" in the config or the number of cores
     with open(f".\\config.json", "r") as f:
         config = json.load(f)
     if pgn_files == None:
         pgn_files = config.get("ingest_dir")
+    if workers == None:
+        workers = config.get("ingest_workers", os.cpu_count() or 1)
     ingested_dir = config.get("ingested_dir", None)
     games = []
 
@@ -400,63 +801,101 @@ def ingest_pgns(pgn_files=None, username=None, mesg_label=None, move_file = True
         pgn_files = glob.glob(os.path.join(pgn_files, "*.pgn"))
         if not pgn_files:
             prints(f"{pgn_files} is empty or contains no .pgn files", mesg_label)
-        for pgn_file in pgn_files:
-            prints(f"Ingesting {pgn_file}", mesg_label)
+        prints(f"Ingesting {len(pgn_files)} pgn files with {workers} workers", mesg_label)
+        file_games = parse_pgn_files(pgn_files, config.get('name') if username == None else username, workers)
+        for pgn_file, pgn_games in zip(pgn_files, file_games):
             if seperate:
-                games.append((pgn_file.split("\\")[-1][:-4],import_pgn_file(pgn_file, username)))
+                games.append((pgn_file.split("\\")[-1][:-4],pgn_games))
             else:
-                games.extend(import_pgn_file(pgn_file, username))
+                games.extend(pgn_games)
             prints(f"Done ingesting {pgn_file}", mesg_label)
             if move_file and ingested_dir:
-                if not os.path.exists(ingested_dir):
-                    os.makedirs(ingested_dir)
-                file_name = pgn_file.split('\\')[-1]
-                move_file = f"{ingested_dir}\\{file_name}"
-                prints(f"Moving to {move_file}", mesg_label)
-                shutil.move(pgn_file, ingested_dir)
+                move_ingested_file(pgn_file, ingested_dir, mesg_label)
         
         
     elif os.path.isfile(pgn_files) and pgn_files.lower().endswith(".pgn"):
         prints(f"Ingesting {pgn_files}", mesg_label)
         
+        # A single file is parsed for the configured player, as import_pgn_file(pgn_files) did
+        pgn_games = parse_pgn_files([pgn_files], config.get('name'), workers)[0]
         if study: 
-            games = [(pgn_files.split("\\")[-1][:-4],import_pgn_file(pgn_files))]
+            games = [(pgn_files.split("\\")[-1][:-4],pgn_games)]
         else:
-            games = [import_pgn_file(pgn_files)]
+            games = [pgn_games]
         prints(f"Done ingesting {pgn_files}", mesg_label)
 
         if move_file and ingested_dir:
-            if not os.path.exists(ingested_dir):
-                os.makedirs(ingested_dir)
-            file_name = pgn_files.split('\\')[-1]
-            move_file = f"{ingested_dir}\\{file_name}"
-            prints(f"Moving to {move_file}", mesg_label)
-            shutil.move(pgn_files, ingested_dir)
+            move_ingested_file(pgn_files, ingested_dir, mesg_label)
     
 
     return games
     
+def move_ingested_file(pgn_file, ingested_dir, mesg_label=None):
+    if not os.path.exists(ingested_dir):
+        os.makedirs(ingested_dir)
+    file_name = pgn_file.split('\\')[-1]
+    prints(f"Moving to {ingested_dir}\\{file_name}", mesg_label)
+    shutil.move(pgn_file, ingested_dir)
+
+def find_pgn_files(pgn_files):
+    # The .pgn files of a directory, or pgn_files itself when it is a .pgn file
+    if os.path.isdir(pgn_files):
+        return glob.glob(os.path.join(pgn_files, "*.pgn"))
+    if os.path.isfile(pgn_files) and pgn_files.lower().endswith(".pgn"):
+        return [pgn_files]
+    return []
+
+def iter_pgn_files_games(pgn_files, username=None, workers=None, mesg_label=None):
+    # Games of every file one at a time, in file order, parsed like parse_pgn_files
+    current_file = None
+    for i, games in iter_pgn_file_chunks(pgn_files, username, workers):
+        if i != current_file:
+            current_file = i
+            prints(f"Ingesting {pgn_files[i]}", mesg_label)
+        yield from games
+
+def import_workers(config):
+    # (pgn parse workers, prepare workers) of import_all_games. The parse pool feeds the prepare pool, so both run at
+    # once and share one process per core, the importing process counting as one. Parsing is about a twentieth of the
+    # work of sanitizing and replaying, so by default it stays in the importing process and the other cores prepare.
+    # "ingest_workers" and "prepare_workers" in the config override the split
+    cores = os.cpu_count() or 1
+    ingest_workers = config.get("ingest_workers") or 1
+    prepare_workers = config.get("prepare_workers") or max(1, cores - ingest_workers)
+    return ingest_workers, prepare_workers
+
 def prints(mesg, mesg_label=None):
     print(mesg)
     if mesg_label:
         mesg_label.config(text=mesg)
 
 def update_imported(file_name, add_fens=True):
+    # Replays the SAN moves of the imported games into move codes again and rewrites their game store, a legacy json
+    # file is moved into the store. Stored games only keep SAN when their replay failed partway (see add_fens), the
+    # store is only rewritten when some of those were replayed again
     with open(f".\\config.json", "r") as f:
         config = json.load(f)
     imported_dir = config.get("imported_dir")
+    store = GameStore(os.path.join(imported_dir, file_name))
     full_file_path = f"{imported_dir}\\{file_name}.json"
-    if os.path.isfile(full_file_path):
+    if len(store):
+        games = store.load()
+    elif os.path.isfile(full_file_path):
         with open(full_file_path, "r") as f:
             games_dict = json.load(f)
-        games = games_dict.get("white_games")
-        games.extend(games_dict.get("black_games"))
-        games.extend(games_dict.get("other_games"))
+        games = games_dict.get("white_games",[]) + games_dict.get("black_games",[]) + games_dict.get("other_games",[])
+    else:
+        return None
 
+    replayed = []
     if add_fens:
-        add_fen_list(games)
+        replayed = [g for g in games if g.get("clean_moves")]
+        add_fen_list(replayed)
 
-    dump_games(games, file_name=file_name)
+    if len(store) and not replayed:
+        return games
+    store.replace(games)
+    return games
 
 def dump_games(games, file_name=None,  mesg_label=None, sub_mesg_label=None, filter_games = True):
 
@@ -475,7 +914,7 @@ def dump_games(games, file_name=None,  mesg_label=None, sub_mesg_label=None, fil
     fp= f".\\{imported_dir}\\{file_name}.json"
     prints(f"Imported {len(games)} in total, saving to {fp}",sub_mesg_label)
     with open(fp, "w") as f:
-        json.dump(games_json,f)
+        json.dump(games_json,f,default=json_default)
     prints(f"Saved to {fp}",sub_mesg_label)
 
 def dump_study(study, file_name=None,  mesg_label=None, sub_mesg_label=None):
@@ -495,6 +934,8 @@ def dump_study(study, file_name=None,  mesg_label=None, sub_mesg_label=None):
     prints(f"Saved to {fp}",sub_mesg_label)
 
 def import_all_games(file_name=None, chess_com_user=None, lichess_user=None, pgns_files=None, time_formats = None, append=True, rated=True, from_date=None, to_date=None, mesg_label=None, sub_mesg_label=None):
+    # Imports the games into the game store of file_name and returns the number of games imported, the games are
+    # streamed into the store instead of being returned (load them with load_games(file_name))
     with open(f".\\config.json", "r") as f:
         config = json.load(f)
     
@@ -507,37 +948,68 @@ def import_all_games(file_name=None, chess_com_user=None, lichess_user=None, pgn
     if pgns_files == None or pgns_files == "":
         pgns_files = config.get("ingest_dir", False)
     
+    # Games are appended to a GameStore directory, only the new games are sanitized, replayed and written
     imported_dir = config.get("imported_dir")
+    store = GameStore(os.path.join(imported_dir, file_name))
     full_file_path = f"{imported_dir}\\{file_name}.json"
-    if os.path.isfile(full_file_path) and append:
-        prints(f"File {full_file_path} is already found so appending games", mesg_label)
+    if not append:
+        # The stored games are only replaced once the new ones are written
+        prints(f"Replacing the games of {store.path}", mesg_label)
+    elif len(store):
+        prints(f"Game store {store.path} already has {len(store)} games so appending games", mesg_label)
+    elif os.path.isfile(full_file_path):
+        prints(f"File {full_file_path} is already found so moving its games to the game store {store.path}", mesg_label)
         with open(full_file_path, "r") as f:
             games_dict = json.load(f)
-            games = games_dict.get("white_games")
-            games.extend(games_dict.get("black_games",[]))
-            games.extend(games_dict.get("other_games",[]))
-    else:
-        games = []
+        store.append(games_dict.get("white_games",[]) + games_dict.get("black_games",[]) + games_dict.get("other_games",[]))
+    games = []
+    # Lichess games are prepared with the other games and written while they stream in
+    lichess_games = []
+    pgn_files = []
 
     if chess_com_user:
         prints(f"Ingesting Chess.com Games from user {chess_com_user}", mesg_label)
-        games.extend(get_chess_com_games(chess_com_user,time_formats = time_formats, rated=rated, from_date=from_date, to_date=to_date, mesg_label=sub_mesg_label))
+        games.extend(get_chess_com_games(chess_com_user,time_formats = time_formats, rated=rated, from_date=from_date, to_date=to_date, mesg_label=sub_mesg_label) or [])
     if lichess_user:
         prints(f"Ingesting Lichess Games from user {lichess_user}", mesg_label)
         from_epoch = date_to_epoch(from_date)
         to_epoch = date_to_epoch(to_date)
+        known_ids = None
+        watermark = store.latest_end_time("lichess", lichess_user) if append else None
+        if watermark:
+            prints(f"Already have lichess games of {lichess_user} up to {datetime.fromtimestamp(watermark)}, only downloading newer ones", sub_mesg_label)
+            from_epoch = max(from_epoch or 0, watermark - LICHESS_SYNC_OVERLAP)
+            known_ids = {g.get("id") for g in store.iter_games(segments=store.segments_since("lichess", lichess_user, from_epoch))}
 
-        games.extend(get_lichess_games(lichess_user,time_formats = time_formats, rated=rated, from_epoch=from_epoch, to_epoch=to_epoch, mesg_label=sub_mesg_label))
+        lichess_games = iter_user_lichess_games(lichess_user,time_formats = time_formats, rated=rated, from_epoch=from_epoch, to_epoch=to_epoch, mesg_label=sub_mesg_label, sub_mesg_label=sub_mesg_label, known_ids=known_ids)
     if pgns_files:
         prints(f"Ingesting Pgns files {pgns_files}",mesg_label)
-        games.extend(ingest_pgns(pgns_files,mesg_label=sub_mesg_label))  
-    
-    sanitize_png_moves(games,mesg_label=mesg_label, sub_mesg_label=sub_mesg_label)
-    add_fen_list(games,mesg_label=mesg_label, sub_mesg_label=sub_mesg_label)
+        pgn_files = find_pgn_files(pgns_files)
+        if not pgn_files:
+            prints(f"{pgns_files} is empty or contains no .pgn files", sub_mesg_label)
+
+    # The pgn files are parsed and the lichess export downloaded while the games of every source are sanitized,
+    # replayed and written to the new segment, only the games in flight are in memory
+    ingest_workers, prepare_workers = import_workers(config)
+    pgn_games = iter_pgn_files_games(pgn_files, config.get('name'), ingest_workers, sub_mesg_label)
+    new_games = iter_prepared_games(chain(games, pgn_games, lichess_games), workers=prepare_workers, mesg_label=sub_mesg_label)
 
-    dump_games(games, file_name=file_name,  mesg_label=mesg_label, sub_mesg_label=sub_mesg_label)
+    prints("Saving Files",mesg_label)
+    if append:
+        segment = store.append(new_games)
+    else:
+        segment = store.replace(new_games)
+        if segment is None and len(store):
+            prints(f"No games were imported, keeping the {len(store)} games in {store.path}", mesg_label)
+    imported = segment["games"] if segment else 0
+    prints(f"Imported {imported} new games, {len(store)} in total in {store.path}",sub_mesg_label)
+
+    ingested_dir = config.get("ingested_dir", None)
+    if ingested_dir:
+        for pgn_file in pgn_files:
+            move_ingested_file(pgn_file, ingested_dir, sub_mesg_label)
     
-    return games
+    return imported
 
 def import_studies(file_name=None, study_as='w', seperate=True, pgns_files=None, mesg_label=None, sub_mesg_label=None):
     with open(f".\\config.json", "r") as f:
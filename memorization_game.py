@@ -19,6 +19,8 @@ class MemorizationGame:
         self.valid_moves = None
         self.from_coords = []
         self.to_coords = []
+        # Parsed board of each visited node by FEN, a puzzle plays on a copy of it
+        self.node_boards = {}
         for study_tree in study_trees:
             self.testing_nodes.extend([(node,study_tree.name) for node in study_tree.get_test_nodes()])
 
@@ -71,12 +73,18 @@ class MemorizationGame:
     def get_hint(self):
         return f"Hint: The move(s) starts with {', '.join([move[0] for move in self.valid_moves])}..."
 
+    def node_board(self, node):
+        board = self.node_boards.get(node.fen)
+        if board is None:
+            board = self.node_boards[node.fen] = Board(node.fen)
+        return board.copy()
+
     def return_to_last_node(self):
         if len(self.visited_nodes) >=2:
             self.current_test_node = self.visited_nodes[-2]
             self.visited_nodes = self.visited_nodes[:-1]
             self.current_subtitle = f"From {self.current_study_tree_name}: ({', '.join([s.get('event','') for s in self.current_test_node.studies])})"
-            self.current_board =  Board(self.current_test_node.fen)
+            self.current_board = self.node_board(self.current_test_node)
             self.valid_moves = [move for _, move in self.current_test_node.children]
             self.from_coords = [self.current_board.get_to_from_square_algebraic_move(move,return_bitboard=False)[0] for move in self.valid_moves]
             self.to_coords = [self.current_board.get_to_from_square_algebraic_move(move,return_bitboard=False)[1] for move in self.valid_moves]
@@ -85,7 +93,7 @@ class MemorizationGame:
         self.current_test_node, self.current_study_tree_name = rand.choice(self.testing_nodes)
         self.visited_nodes.append(self.current_test_node)
         self.current_subtitle = f"From {self.current_study_tree_name}: ({', '.join([s.get('event','') for s in self.current_test_node.studies])})"
-        self.current_board =  Board(self.current_test_node.fen)
+        self.current_board = self.node_board(self.current_test_node)
         self.valid_moves = [move for _, move in self.current_test_node.children]
         self.from_coords = [self.current_board.get_to_from_square_algebraic_move(move,return_bitboard=False)[0] for move in self.valid_moves]
         self.to_coords = [self.current_board.get_to_from_square_algebraic_move(move,return_bitboard=False)[1] for move in self.valid_moves]
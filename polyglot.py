@@ -0,0 +1,124 @@
+import os
+import mmap
+import struct
+from board import Board, PROMOTION_PIECES
+
+# Book entry: key, move, weight, learn, big endian, sorted by key. http://hgm.nubati.net/book_format.html
+ENTRY_STRUCT = struct.Struct(">QHHI")
+KEY_STRUCT = struct.Struct(">Q")
+# Polyglot writes castling as the king taking its own rook
+CASTLE_ROOK_SQUARES = {(4, 6): 7, (4, 2): 0, (60, 62): 63, (60, 58): 56}
+CASTLE_KING_SQUARES = {(4, 7): 6, (4, 0): 2, (60, 63): 62, (60, 56): 58}
+
+def encode_polyglot_move(board, move):
+    # Polyglot move of a (from_bb, to_bb, promote) move: to file, to rank, from file, from rank, promotion piece, 3 bits each
+    from_bb, to_bb, promote = move
+    from_square, to_square = from_bb.bit_length() - 1, to_bb.bit_length() - 1
+    if abs(board.squares[from_square]) == 6:
+        to_square = CASTLE_ROOK_SQUARES.get((from_square, to_square), to_square)
+    promotion = PROMOTION_PIECES.index(promote.upper()) + 1 if promote else 0
+    return to_square | from_square << 6 | promotion << 12
+
+def decode_polyglot_move(board, polyglot_move):
+    from_square, to_square = polyglot_move >> 6 & 0x3F, polyglot_move & 0x3F
+    if abs(board.squares[from_square]) == 6:
+        to_square = CASTLE_KING_SQUARES.get((from_square, to_square), to_square)
+    promotion = polyglot_move >> 12 & 0x7
+    return (1 << from_square, 1 << to_square, PROMOTION_PIECES[promotion - 1] if promotion else None)
+
+def write_book(path, entries):
+    # entries are (key, move, weight, learn) tuples, written sorted by key with the heaviest move first
+    entries = sorted(entries, key=lambda entry: (entry[0], -entry[2]))
+    with open(path, "wb") as f:
+        for entry in entries:
+            f.write(ENTRY_STRUCT.pack(*entry))
+    return len(entries)
+
+def opening_tree_entries(tree):
+    # One entry per move played from every position of the tree, weighted by the games that played that move from
+    # that position. The games of the child node would count every game that transposed into it as well
+    counts = {}
+    for node in tree.nodes.values():
+        if not node.move_counts:
+            continue
+        board = Board(node.fen)
+        key = board.polyglot_key()
+        for move, count in node.move_counts.items():
+            parsed_move = board.san_to_move(move)
+            if parsed_move is None:
+                continue
+            entry = (key, encode_polyglot_move(board, parsed_move))
+            counts[entry] = counts.get(entry, 0) + count
+    # Weights are 16 bit, scale every position down when its most played move doesn't fit
+    max_counts = {}
+    for (key, _), count in counts.items():
+        max_counts[key] = max(max_counts.get(key, 0), count)
+    entries = []
+    for (key, move), count in counts.items():
+        if max_counts[key] > 0xFFFF:
+            count = max(1, count * 0xFFFF // max_counts[key])
+        entries.append((key, move, count, 0))
+    return entries
+
+def export_opening_tree(tree, path):
+    return write_book(path, opening_tree_entries(tree))
+
+class PolyglotBook:
+    # Read only view of a .bin book, the file is memory mapped and entries are found by binary search on the key
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        # mmap can't map an empty file
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+        self.size = len(self.mmap) // ENTRY_STRUCT.size
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self.mmap, mmap.mmap):
+            self.mmap.close()
+        self.file.close()
+
+    def entry(self, index):
+        return ENTRY_STRUCT.unpack_from(self.mmap, index * ENTRY_STRUCT.size)
+
+    def key_at(self, index):
+        return KEY_STRUCT.unpack_from(self.mmap, index * ENTRY_STRUCT.size)[0]
+
+    def first_index(self, key):
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find_entries(self, key):
+        # key is a polyglot key or a Board
+        if isinstance(key, Board):
+            key = key.polyglot_key()
+        entries = []
+        index = self.first_index(key)
+        while index < self.size and self.key_at(index) == key:
+            entries.append(self.entry(index))
+            index += 1
+        return entries
+
+    def get_moves(self, board):
+        # [(san, weight)] of the book moves in this position, heaviest first
+        moves = []
+        for _, polyglot_move, weight, _ in self.find_entries(board):
+            move = decode_polyglot_move(board, polyglot_move)
+            if move in board.generate_legal_moves(move[0], move[1]):
+                moves.append((board.move_to_san(move), weight))
+        moves.sort(key=lambda move: move[1], reverse=True)
+        return moves
@@ -1,5 +1,6 @@
 import import_games
-from study_board import Board
+import polyglot
+from board import Board
 
 class Node:
     def __init__(self, fen, from_move = None, parent = None):
@@ -10,6 +11,8 @@ class Node:
         self.games = []
         self.results = []
         self.times = []
+        # Number of games that played each move from this position, transpositions included
+        self.move_counts = {}
 
     def add_child(self, fen, move, game):
         child = Node(fen, from_move = move, parent = self)
@@ -83,8 +86,11 @@ class OpeningTree:
         if not open_fen:
             open_fen = Board.STARTING_FEN
         self.root = Node(open_fen)
-        self.nodes = {open_fen:self.root}
+        # Nodes are keyed by the Zobrist key of the position
+        self.nodes = {Board(open_fen).key:self.root}
         self.is_white=is_white
+        # SAN of a move code played from a position, by (Zobrist key, move code)
+        self.move_sans = {}
         if games:
             for game in games:
                 self.add_game(game)
@@ -93,24 +99,67 @@ class OpeningTree:
         current_node = self.root
         current_node.add_game(game)
 
+        codes = game.get("move_codes",None)
+        if codes:
+            # Positions are replayed from the move codes, the SAN is only built for moves and the FEN for positions
+            # new to the tree
+            board = Board.from_template(self.root.fen)
+            played = set()
+            for code in codes:
+                decoded_move = board.decode_move(code)
+                move = self.move_sans.get((board.key, code))
+                if move is None:
+                    # The check mark is read off the position the move is played into anyway
+                    parent_key = board.key
+                    move = board.san_without_check(decoded_move)
+                    board.make_move(decoded_move)
+                    move = self.move_sans[(parent_key, code)] = move + board.check_mark()
+                else:
+                    board.make_move(decoded_move)
+                current_node = self.add_move(current_node, move, board.key, lambda: board.current_fen, game, played)
+            return
+
+        # Games imported before move codes were stored keep their FENs
         fen_list = game.get("move_fen_list",None)
         if fen_list:
-            for move,fen in fen_list:
-                child = self.nodes.get(fen,None)
-                if child:
-                    if current_node not in child.parents:
-                        child.parents.append(current_node)
-                        child.from_moves.append(move)
-                    child.add_game(game)
-                else:
-                   child = current_node.add_child(fen, move, game)
-                   self.nodes[fen] = child
-                current_node = child
+            # Older files store -1 as the FEN of a move that couldn't be played, the game stops there
+            for ply,(_,fen) in enumerate(fen_list):
+                if not isinstance(fen, str):
+                    fen_list = fen_list[:ply]
+                    break
+            key_list = game.get("move_key_list",None) or [Board(fen).key for _,fen in fen_list]
+            played = set()
+            for (move,fen),key in zip(fen_list,key_list):
+                current_node = self.add_move(current_node, move, key, lambda: fen, game, played)
+
+    def add_move(self, current_node, move, key, get_fen, game, played):
+        # Adds the position reached by playing move from current_node, played holds the (node, move) edges
+        # this game already counted
+        if (id(current_node), move) not in played:
+            played.add((id(current_node), move))
+            current_node.move_counts[move] = current_node.move_counts.get(move, 0) + 1
+        child = self.nodes.get(key,None)
+        if child:
+            if current_node not in child.parents:
+                child.parents.append(current_node)
+                child.from_moves.append(move)
+            # A transposition reaches the child from another parent, which needs the edge as well
+            if (child, move) not in current_node.children:
+                current_node.children.append((child, move))
+            child.add_game(game)
+        else:
+           child = current_node.add_child(get_fen(), move, game)
+           self.nodes[key] = child
+        return child
         
     def sort_children_nodes(self, count=True):
         for node in self.nodes.values():
             node.sort_children(count)
 
+    def export_polyglot(self, path):
+        # Writes the tree as a Polyglot .bin opening book, returns the number of entries
+        return polyglot.export_opening_tree(self, path)
+
 
 class StudyTree:
     def __init__(self, study = None, open_fen = None):
@@ -118,7 +167,7 @@ class StudyTree:
             open_fen = Board.STARTING_FEN
         self.name = study.get("name")
         self.root = StudyNode(open_fen)
-        self.nodes = {open_fen:self.root}
+        self.nodes = {Board(open_fen).key:self.root}
         self.is_white = study.get("study_as") == 'w' 
         self.color = study.get("study_as")
         self.studies = []
@@ -134,85 +183,68 @@ class StudyTree:
             return 
         self.studies.append(study)
         current_node = self.root
-        moves = study.get("moves","").split(" ")
-
         current_board = Board(self.root.fen)
-        last_fen = self.root.fen
         variation_stack = []
-        open_comment = False
-        comment = ""
-        pop_count = 0
-        ply = 0
-        if moves:
-            for i, move in enumerate(moves[:-1]):
-                
-                if open_comment or move[0] == '$':
-                    if move[0] == "}" or move[0] == '$':
-                        pop_count = move.count(')')
-                        
-                        while pop_count > 0:
-                            current_board,current_node = variation_stack.pop()
-                            last_fen = current_board.last_fen
-                            pop_count -=1
-                            move = move[:-1]
-                        current_node.notes.append(f"{comment}{import_games.ANNOTATION_NAGS.get(f'{move[1:]}','')}")
-                        open_comment = False
-                        comment = ''
-                        
-                    elif comment:
-                        comment = f"{comment}{move}"
-                    else:
-                        comment = move
-
-                elif move == "{":
-                    open_comment = True
-
-                elif move[0] == '(':
-                    if move.endswith("..."):
-                        ply = 2*int(move[1:-3])
-                    else:
-                        ply = 2*int(move[1:-1]) -1
-                    variation_stack.append ((current_board, current_node))
-                    current_board = Board(last_fen)
-                    current_node = self.nodes.get(last_fen)
-
-                
-                elif move[0].isdigit():
-                    if move.endswith("..."):
-                        ply = 2*int(move[:-3])
-                    else:
-                        ply = 2*int(move[:-1]) -1
+        skipped_depth = 0
+        # Open variations inside the variation that holds a move that couldn't be played, the rest of that
+        # variation is skipped and its end is handled as usual
+        dropped_depth = 0
+        for kind, value in import_games.iter_pgn_tokens(study.get("moves","")):
+            if skipped_depth:
+                if kind == import_games.VARIATION_START:
+                    skipped_depth += 1
+                elif kind == import_games.VARIATION_END:
+                    skipped_depth -= 1
+                continue
+            if dropped_depth:
+                if kind == import_games.VARIATION_START:
+                    dropped_depth += 1
+                elif kind == import_games.VARIATION_END:
+                    dropped_depth -= 1
+                if dropped_depth:
+                    continue
 
+            if kind == import_games.SAN:
+                current_fen = current_board.push(value)
+                if current_fen == -1:
+                    if not variation_stack:
+                        print(f"Could not play {value} in the main line of {study.get('event', self.name)}, skipping the rest of the study")
+                        break
+                    print(f"Could not play {value} in {study.get('event', self.name)}, skipping the rest of its variation")
+                    dropped_depth = 1
+                    continue
+                test = current_fen.split(" ")[1] == self.color
+                child = self.nodes.get(current_board.key, None)
+                if child:
+                    if (current_node, value) not in child.parents_and_moves:
+                        child.parents_and_moves.append((current_node, value))
+                    if (child, value) not in current_node.children:
+                        current_node.children.append((child, value))
                 else:
-                    pop_count = move.count(')')
-                    if pop_count:
-                        move= move[:-pop_count]
-                    
-
-                    while move[-1] == '!' or move[-1] == '?':
-                        comment=f"{move[-1]}{comment}"
-                        move = move[:-1]
-
-                    last_fen = current_node.fen
-                    current_fen = current_board.make_algebraic_move(move)
-                    test = current_fen.split(" ")[1] == self.color
-                    child = self.nodes.get(current_fen, None)
-                    if child:
-                        if (current_node, move) not in child.parents_and_moves:
-                            child.parents_and_moves.append((current_node, move))
-                    else:
-                        child = current_node.add_child(current_fen,move,study, test = test)
-                        self.nodes[current_fen] = child
-                    current_node = child
-                    if comment:
-                        current_node.notes.append(comment)
-                        comment=""
-                    while pop_count > 0:
-                        current_board,current_node = variation_stack.pop()
-
-                        last_fen = current_board.last_fen
-                        pop_count -=1
-                    ply += 1
+                    child = current_node.add_child(current_fen,value,study, test = test)
+                    self.nodes[current_board.key] = child
+                current_node = child
+
+            elif kind == import_games.VARIATION_START:
+                # Take back the last move to start the variation, it is replayed when the variation closes.
+                # A variation before the first move has no move to take back and is skipped
+                if not current_board.undo_stack:
+                    skipped_depth = 1
+                    continue
+                variation_stack.append((current_node, current_board.pop(), len(current_board.undo_stack)))
+                current_node = self.nodes.get(current_board.key)
+
+            elif kind == import_games.VARIATION_END and variation_stack:
+                current_node, variation_move, depth = variation_stack.pop()
+                while len(current_board.undo_stack) > depth:
+                    current_board.pop()
+                current_board.push(variation_move)
+
+            elif kind == import_games.COMMENT and value:
+                current_node.notes.append(value)
+
+            elif kind == import_games.NAG and value in import_games.ANNOTATION_NAGS:
+                current_node.notes.append(import_games.ANNOTATION_NAGS[value])
 
     def get_test_nodes(self):
         return [n for n in self.nodes.values() if n.test and n.children]
@@ -221,11 +253,11 @@ class StudyTree:
 
 def run_through_game(game):
     b=Board()
-    moves = game.get("clean_moves",None)
+    moves = game.get("clean_moves",None) or Board.decode_moves(game.get("move_codes",[]))
     if moves:
         for i,m in enumerate(moves):
             
-            made = b.make_algebraic_move(m)
+            made = b.make_algebraic_move(m, return_fen=False)
             if made == -1:
                 input("AHHHHHHHHHH")
             #b.display()